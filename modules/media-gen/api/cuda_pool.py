@@ -0,0 +1,52 @@
+"""
+AMFbot CUDA Memory Pool
+
+Startup configuration of PyTorch's CUDA caching allocator:
+- Expandable segments to limit fragmentation
+- Per-process VRAM cap
+- Optional pre-growth of the pool to avoid cudaMalloc on first request
+
+License: Apache-2.0
+"""
+
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Fraction of total VRAM this process may use
+VRAM_FRACTION = float(os.environ.get("AMFBOT_VRAM_FRAC", 0.9))
+# Fraction of free VRAM to reserve up front (0 disables priming). Only enable
+# it when one process owns the GPU, since reserved memory is not shared.
+VRAM_PRIME = float(os.environ.get("AMFBOT_VRAM_PRIME", 0))
+
+
+def configure_allocator() -> None:
+    """
+    Set allocator options before torch initializes CUDA.
+    
+    PYTORCH_CUDA_ALLOC_CONF is read once at CUDA initialization, so this must
+    run before the first CUDA call. Spawned worker processes inherit it.
+    """
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+
+def reserve_cuda_memory() -> None:
+    """Cap this process's VRAM share and optionally pre-grow the allocator pool."""
+    import torch
+    
+    if not torch.cuda.is_available():
+        return
+    
+    torch.cuda.set_per_process_memory_fraction(VRAM_FRACTION)
+    
+    if VRAM_PRIME > 0:
+        free, _ = torch.cuda.mem_get_info()
+        size = int(free * VRAM_PRIME)
+        
+        # Freed blocks stay in the caching allocator and are reused without
+        # another cudaMalloc, so don't empty_cache() afterwards
+        block = torch.empty(size, dtype=torch.uint8, device="cuda")
+        del block
+        
+        logger.info(f"Reserved {size / (1024 ** 3):.1f}GB CUDA memory pool")
@@ -0,0 +1,156 @@
+"""
+AMFbot Job Store
+
+Durable storage for generation job records:
+- SQLite (WAL mode) so jobs survive server restarts
+- In-memory TTL cache of finished jobs for cheap status polling
+- Expiry of old jobs together with their output files
+
+License: Apache-2.0
+"""
+
+import time
+import logging
+import secrets
+from pathlib import Path
+from typing import Optional
+
+import aiosqlite
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+class JobStore:
+    """SQLite-backed job records with an in-memory cache in front."""
+    
+    def __init__(
+        self,
+        db_path: Path,
+        cache_size: int = 10000,
+        ttl: int = 3600,
+        owner: Optional[str] = None,
+    ):
+        """
+        Initialize the job store.
+        
+        Args:
+            db_path: Path of the SQLite database file
+            cache_size: Maximum number of finished jobs kept in memory
+            ttl: Seconds after their last update before jobs expire
+            owner: ID of the server run creating jobs, shared by its worker
+                processes (default: unique to this store)
+        """
+        self.db_path = db_path
+        self.ttl = ttl
+        self.owner = owner or secrets.token_hex(8)
+        # Only finished jobs are cached, since they can no longer change
+        self._cache: TTLCache = TTLCache(maxsize=cache_size, ttl=ttl)
+        self._db: Optional[aiosqlite.Connection] = None
+    
+    async def open(self) -> None:
+        """Open the database, creating the schema if needed."""
+        self._db = await aiosqlite.connect(self.db_path)
+        await self._db.execute("PRAGMA journal_mode=WAL")
+        await self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, status TEXT NOT NULL, result TEXT, error TEXT, "
+            "created REAL NOT NULL, updated REAL NOT NULL, owner TEXT)"
+        )
+        async with self._db.execute("PRAGMA table_info(jobs)") as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        if "owner" not in columns:
+            await self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        
+        # Jobs of a previous server run will never finish. Jobs of this run
+        # belong to live sibling workers, so they are left alone.
+        cursor = await self._db.execute(
+            "UPDATE jobs SET status = 'failed', error = ? "
+            "WHERE status NOT IN ('completed', 'failed') AND owner IS NOT ?",
+            ("Interrupted by server restart", self.owner),
+        )
+        if cursor.rowcount:
+            logger.warning(f"Marked {cursor.rowcount} interrupted job(s) as failed")
+        
+        await self._db.commit()
+    
+    async def close(self) -> None:
+        """Close the database."""
+        if self._db:
+            await self._db.close()
+            self._db = None
+    
+    async def get(self, job_id: str) -> Optional[dict]:
+        """Get a job record, or None if it doesn't exist."""
+        job = self._cache.get(job_id)
+        if job is not None:
+            return job
+        
+        async with self._db.execute(
+            "SELECT status, result, error FROM jobs WHERE id = ?", (job_id,)
+        ) as cursor:
+            row = await cursor.fetchone()
+        
+        if row is None:
+            return None
+        
+        status, result, error = row
+        job = {"status": status}
+        if result is not None:
+            job["result"] = result
+        if error is not None:
+            job["error"] = error
+        
+        if status in TERMINAL_STATUSES:
+            self._cache[job_id] = job
+        return job
+    
+    async def set(self, job_id: str, job: dict) -> None:
+        """Create or replace a job record."""
+        now = time.time()
+        await self._db.execute(
+            "INSERT INTO jobs (id, status, result, error, created, updated, owner) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET status = excluded.status, "
+            "result = excluded.result, error = excluded.error, updated = excluded.updated",
+            (job_id, job["status"], job.get("result"), job.get("error"), now, now, self.owner),
+        )
+        await self._db.commit()
+        
+        if job["status"] in TERMINAL_STATUSES:
+            self._cache[job_id] = job
+    
+    async def purge_expired(self) -> int:
+        """
+        Delete finished jobs older than the TTL along with their output files.
+        
+        Returns:
+            Number of jobs deleted
+        """
+        cutoff = time.time() - self.ttl
+        async with self._db.execute(
+            "SELECT id, result FROM jobs WHERE updated < ? AND status IN ('completed', 'failed')",
+            (cutoff,),
+        ) as cursor:
+            rows = await cursor.fetchall()
+        
+        for job_id, result in rows:
+            if result:
+                # Multi-output jobs write {job_id}_{i} files next to the first result
+                output_dir = Path(result).parent
+                outputs = [*output_dir.glob(f"{job_id}.*"), *output_dir.glob(f"{job_id}_*")]
+                for path in [Path(result), *outputs]:
+                    path.unlink(missing_ok=True)
+            self._cache.pop(job_id, None)
+        
+        await self._db.execute(
+            "DELETE FROM jobs WHERE updated < ? AND status IN ('completed', 'failed')",
+            (cutoff,),
+        )
+        await self._db.commit()
+        
+        if rows:
+            logger.info(f"Purged {len(rows)} expired job(s)")
+        return len(rows)
@@ -11,18 +11,34 @@ License: Apache-2.0
 """
 
 import os
-import uuid
+import time
 import asyncio
+import hashlib
 import logging
+import itertools
+import secrets
+import threading
+import multiprocessing
 from pathlib import Path
-from typing import Optional, Literal
+from typing import Optional, Literal, List
+from dataclasses import asdict
 from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
+import orjson
 from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 
+from downloader import ModelDownloader
+from api.cuda_pool import configure_allocator, reserve_cuda_memory
+from api.job_store import JobStore
+
+# Allocator options must be set before the wrappers import torch
+configure_allocator()
+
 # Conditional imports for AI models
 try:
     from video.ltx_wrapper import LTXVideoWrapper, VideoGenerationConfig
@@ -31,7 +47,20 @@ except ImportError:
     HAS_VIDEO = False
 
 try:
-    from image.flux_wrapper import FluxWrapper, ImageGenerationConfig
+    import torch
+    from image.flux_wrapper import (
+        FLUX_MODELS,
+        PRECISION_MIN_CAPABILITY,
+        ImageGenerationConfig,
+        precision_supported,
+    )
+    from api.workers import (
+        get_image_worker_capability,
+        init_image_worker,
+        preload_image_worker,
+        run_image_job,
+        unload_image_worker,
+    )
     HAS_IMAGE = True
 except ImportError:
     HAS_IMAGE = False
@@ -39,17 +68,70 @@ except ImportError:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Output directory
+OUTPUT_DIR = Path(os.environ.get("AMFBOT_OUTPUT_DIR", "./outputs"))
+OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+# Seconds between sweeps for expired jobs
+JOB_PURGE_INTERVAL = 300
+
+# ID of this server run. Set before uvicorn starts its workers, so they all
+# inherit it and don't fail each other's jobs when opening the job store.
+BOOT_ID = os.environ.setdefault("AMFBOT_BOOT_ID", secrets.token_hex(8))
+
+
 # Generation state
 class GenerationState:
     video_wrapper: Optional["LTXVideoWrapper"] = None
-    image_wrapper: Optional["FluxWrapper"] = None
-    jobs: dict = {}
+    # Held by a generation thread for its whole video job: the LTX pipeline's
+    # scheduler state is per pipeline, and swaps unload the current wrapper
+    video_lock = threading.Lock()
+    # Bounded pool for in-process generation; also caps concurrent GPU jobs
+    gen_executor: Optional[ThreadPoolExecutor] = None
+    # One single-process executor per GPU; Flux wrappers live in the workers
+    image_executors: List[ProcessPoolExecutor] = []
+    image_gpu_indices: List[Optional[int]] = []
+    # Calls are submitted to each worker one at a time, so a worker crash
+    # only fails the call that was running
+    image_locks: List[asyncio.Lock] = []
+    image_worker_info: List[dict] = []
+    # CUDA compute capability of each image worker's GPU (None without CUDA)
+    image_capabilities: list = []
+    image_rr: Optional[itertools.cycle] = None
+    jobs: JobStore = JobStore(
+        OUTPUT_DIR / "jobs.sqlite",
+        cache_size=int(os.environ.get("AMFBOT_JOB_CACHE", 10000)),
+        ttl=int(os.environ.get("AMFBOT_JOB_TTL", 3600)),
+        owner=BOOT_ID,
+    )
+    # Request content hash -> job ID of the pending/processing job
+    inflight: dict = {}
 
 state = GenerationState()
+downloader = ModelDownloader()
 
-# Output directory
-OUTPUT_DIR = Path(os.environ.get("AMFBOT_OUTPUT_DIR", "./outputs"))
-OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+# Downloader model ID for the video wrapper
+VIDEO_MODEL_ID = "ltx-video-distilled"
+
+# Comma-separated Flux variants and/or video model IDs to load at startup
+PRELOAD = [m.strip() for m in os.environ.get("AMFBOT_PRELOAD", "").split(",") if m.strip()]
+
+# Internal nginx location aliasing OUTPUT_DIR. When set, downloads return only
+# an X-Accel-Redirect header and nginx sendfile()s the bytes to the client.
+ACCEL_REDIRECT_PREFIX = os.environ.get("AMFBOT_ACCEL_REDIRECT_PREFIX")
+
+# Polling interval of the job status event stream, in seconds
+JOB_STREAM_INTERVAL = 0.25
+
+
+async def purge_expired_jobs() -> None:
+    """Periodically delete expired jobs and their outputs."""
+    while True:
+        try:
+            await state.jobs.purge_expired()
+        except Exception as e:
+            logger.exception(f"Job purge failed: {e}")
+        await asyncio.sleep(JOB_PURGE_INTERVAL)
 
 
 @asynccontextmanager
@@ -58,12 +140,38 @@ async def lifespan(app: FastAPI):
     logger.info("Starting AMFbot Media Generation Server")
     logger.info(f"Video generation available: {HAS_VIDEO}")
     logger.info(f"Image generation available: {HAS_IMAGE}")
+    
+    await state.jobs.open()
+    purge_task = asyncio.create_task(purge_expired_jobs())
+    
+    # Video generation runs in this process
+    if HAS_VIDEO:
+        reserve_cuda_memory()
+        state.gen_executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("AMFBOT_GEN_THREADS", 1)),
+            thread_name_prefix="gen",
+        )
+    
+    if HAS_IMAGE:
+        start_image_workers()
+        state.image_capabilities = await asyncio.gather(*(
+            run_in_image_worker(index, get_image_worker_capability)
+            for index in range(len(state.image_executors))
+        ))
+    
+    if PRELOAD:
+        await preload_models(PRELOAD)
+    
     yield
     # Cleanup on shutdown
+    purge_task.cancel()
+    await state.jobs.close()
     if state.video_wrapper:
-        state.video_wrapper.unload()
-    if state.image_wrapper:
-        state.image_wrapper.unload()
+        state.video_wrapper.unload(purge=True)
+    for executor in state.image_executors:
+        executor.shutdown(wait=False, cancel_futures=True)
+    if state.gen_executor:
+        state.gen_executor.shutdown(wait=False, cancel_futures=True)
     logger.info("Server shutdown complete")
 
 
@@ -72,6 +180,7 @@ app = FastAPI(
     description="REST API for AI-powered image and video generation",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # Enable CORS for local development
@@ -93,6 +202,13 @@ class ImageRequest(BaseModel):
     model: Literal["schnell", "dev"] = Field("schnell", description="Flux model variant")
     seed: Optional[int] = Field(None, description="Random seed for reproducibility")
     num_images: int = Field(1, ge=1, le=4, description="Number of images to generate")
+    cache_threshold: float = Field(
+        0.0, ge=0, le=1, description="First-block cache threshold, ~0.12 recommended (0 = off)"
+    )
+    precision: Literal["bf16", "fp8", "nf4", "fp8-rowwise", "nvfp4"] = Field(
+        "bf16", description="Transformer weight precision"
+    )
+    compile: bool = Field(False, description="Compile the transformer (slow first request)")
 
 
 class VideoRequest(BaseModel):
@@ -103,6 +219,13 @@ class VideoRequest(BaseModel):
     num_frames: int = Field(97, ge=25, le=257, description="Number of frames")
     seed: Optional[int] = Field(None, description="Random seed for reproducibility")
     image_path: Optional[str] = Field(None, description="Input image for img2vid")
+    cache_threshold: float = Field(
+        0.0, ge=0, le=1, description="First-block cache threshold, ~0.05 recommended (0 = off)"
+    )
+    precision: Literal["bf16", "fp8", "nf4", "int8"] = Field(
+        "bf16", description="Transformer weight precision"
+    )
+    compile: bool = Field(False, description="Compile the transformer (slow first request)")
 
 
 class JobResponse(BaseModel):
@@ -120,6 +243,51 @@ class HealthResponse(BaseModel):
     image_loaded: bool
 
 
+# Job IDs are time-ordered so records and output files sort by creation. The
+# random per-process tag keeps IDs unique across uvicorn worker processes.
+_job_id_tag = secrets.token_hex(3)
+_job_id_counter = itertools.count()
+
+
+def _new_job_id() -> str:
+    """Create a unique, time-ordered job ID."""
+    return f"{time.time_ns() // 1_000_000:011x}-{_job_id_tag}-{next(_job_id_counter):06x}"
+
+
+def _request_key(kind: str, request: BaseModel) -> str:
+    """Hash a generation request so identical submissions can be coalesced."""
+    return hashlib.sha1(f"{kind}:{request.model_dump_json()}".encode()).hexdigest()
+
+
+async def _find_inflight(key: str) -> Optional[JobResponse]:
+    """Get the running job for a request key, if any."""
+    job_id = state.inflight.get(key)
+    if job_id is None:
+        return None
+    
+    job = await state.jobs.get(job_id)
+    if job is None:
+        # Registered, but its pending record is still being written
+        return JobResponse(job_id=job_id, status="pending")
+    if job["status"] in ("pending", "processing"):
+        return JobResponse(job_id=job_id, status=job["status"])
+    return None
+
+
+async def _create_job(key: str) -> str:
+    """Create a pending job for a request key and register it as in flight."""
+    job_id = _new_job_id()
+    # Register before the first await, so identical requests arriving
+    # during the store write coalesce onto this job
+    state.inflight[key] = job_id
+    try:
+        await state.jobs.set(job_id, {"status": "pending"})
+    except Exception:
+        state.inflight.pop(key, None)
+        raise
+    return job_id
+
+
 # Endpoints
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
@@ -129,7 +297,7 @@ async def health_check():
         video_available=HAS_VIDEO,
         image_available=HAS_IMAGE,
         video_loaded=state.video_wrapper is not None,
-        image_loaded=state.image_wrapper is not None,
+        image_loaded=any(state.image_worker_info),
     )
 
 
@@ -145,24 +313,98 @@ async def generate_image(request: ImageRequest, background_tasks: BackgroundTask
             detail="Image generation not available. Install Flux dependencies.",
         )
     
-    job_id = str(uuid.uuid4())
-    state.jobs[job_id] = {"status": "pending"}
+    # Jobs go to any worker, so every GPU must run the precision
+    if not all(precision_supported(request.precision, c) for c in state.image_capabilities):
+        major, minor = PRECISION_MIN_CAPABILITY[request.precision]
+        raise HTTPException(
+            status_code=400,
+            detail=f"Precision {request.precision} requires GPUs with compute capability "
+            f"{major}.{minor}+",
+        )
+    
+    key = _request_key("image", request)
+    existing = await _find_inflight(key)
+    if existing:
+        return existing
+    
+    job_id = await _create_job(key)
     
-    background_tasks.add_task(process_image_generation, job_id, request)
+    background_tasks.add_task(process_image_generation, job_id, request, key)
     
     return JobResponse(job_id=job_id, status="pending")
 
 
-async def process_image_generation(job_id: str, request: ImageRequest):
+def _new_image_executor(gpu_index: Optional[int]) -> ProcessPoolExecutor:
+    """Create the single-process executor of the image worker owning a GPU."""
+    return ProcessPoolExecutor(
+        max_workers=1,
+        # CUDA cannot be re-initialized in forked children
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_image_worker,
+        initargs=(gpu_index,),
+    )
+
+
+def start_image_workers() -> None:
+    """Start one image worker process per visible GPU."""
+    gpu_count = torch.cuda.device_count()
+    gpu_indices = list(range(gpu_count)) if gpu_count else [None]
+    
+    state.image_executors = [_new_image_executor(gpu_index) for gpu_index in gpu_indices]
+    state.image_gpu_indices = gpu_indices
+    state.image_locks = [asyncio.Lock() for _ in gpu_indices]
+    state.image_worker_info = [{} for _ in gpu_indices]
+    state.image_rr = itertools.cycle(range(len(gpu_indices)))
+    
+    logger.info(f"Started {len(gpu_indices)} image worker(s)")
+
+
+async def run_in_image_worker(index: int, fn, *args):
+    """
+    Run a call in an image worker, restarting the worker if its process died.
+    
+    A crashed process (e.g. a CUDA abort) breaks its executor for good, so
+    it is replaced and only the call that was running fails.
+    """
+    async with state.image_locks[index]:
+        executor = state.image_executors[index]
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        except BrokenProcessPool as e:
+            executor.shutdown(wait=False, cancel_futures=True)
+            state.image_executors[index] = _new_image_executor(state.image_gpu_indices[index])
+            state.image_worker_info[index] = {}
+            logger.error(f"Image worker {index} died, restarted it")
+            raise RuntimeError("Image worker process died; it has been restarted") from e
+
+
+async def preload_models(model_ids: List[str]) -> None:
+    """Load and warm up models so the first request doesn't pay for it."""
+    loop = asyncio.get_running_loop()
+    
+    variants = [m for m in model_ids if m in FLUX_MODELS] if HAS_IMAGE else []
+    if variants:
+        logger.info(f"Preloading image models: {variants}")
+        results = await asyncio.gather(*(
+            run_in_image_worker(index, preload_image_worker, variants)
+            for index in range(len(state.image_executors))
+        ))
+        state.image_worker_info = list(results)
+    
+    if HAS_VIDEO and VIDEO_MODEL_ID in model_ids:
+        logger.info(f"Preloading video model: {VIDEO_MODEL_ID}")
+        await loop.run_in_executor(state.gen_executor, warmup_video_wrapper)
+    
+    known = (list(FLUX_MODELS) if HAS_IMAGE else []) + [VIDEO_MODEL_ID]
+    unknown = [m for m in model_ids if m not in known]
+    if unknown:
+        logger.warning(f"Ignoring unknown preload models: {unknown}")
+
+
+async def process_image_generation(job_id: str, request: ImageRequest, key: str):
     """Background task for image generation."""
     try:
-        state.jobs[job_id]["status"] = "processing"
-        
-        # Initialize wrapper if needed
-        if state.image_wrapper is None or state.image_wrapper.model_variant != request.model:
-            if state.image_wrapper:
-                state.image_wrapper.unload()
-            state.image_wrapper = FluxWrapper(model_variant=request.model)
+        await state.jobs.set(job_id, {"status": "processing"})
         
         # Generate image
         output_path = OUTPUT_DIR / f"{job_id}.png"
@@ -175,22 +417,29 @@ async def process_image_generation(job_id: str, request: ImageRequest):
             seed=request.seed,
             output_path=str(output_path),
             num_images=request.num_images,
+            cache_threshold=request.cache_threshold,
         )
         
-        # Run in thread pool to avoid blocking
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(
-            None, state.image_wrapper.generate_image, config
+        # Run in a worker process, round-robin across GPUs
+        index = next(state.image_rr)
+        output = await run_in_image_worker(
+            index,
+            run_image_job,
+            request.model,
+            asdict(config),
+            request.precision,
+            request.compile,
         )
+        state.image_worker_info[index] = output["loaded"]
         
-        state.jobs[job_id] = {
-            "status": "completed",
-            "result": result if isinstance(result, str) else result[0],
-        }
+        await state.jobs.set(job_id, {"status": "completed", "result": output["result"]})
         
     except Exception as e:
         logger.exception(f"Image generation failed: {e}")
-        state.jobs[job_id] = {"status": "failed", "error": str(e)}
+        await state.jobs.set(job_id, {"status": "failed", "error": str(e)})
+    
+    finally:
+        state.inflight.pop(key, None)
 
 
 @app.post("/api/generate/video", response_model=JobResponse)
@@ -205,22 +454,66 @@ async def generate_video(request: VideoRequest, background_tasks: BackgroundTask
             detail="Video generation not available. Install LTX-Video dependencies.",
         )
     
-    job_id = str(uuid.uuid4())
-    state.jobs[job_id] = {"status": "pending"}
+    key = _request_key("video", request)
+    existing = await _find_inflight(key)
+    if existing:
+        return existing
+    
+    job_id = await _create_job(key)
     
-    background_tasks.add_task(process_video_generation, job_id, request)
+    background_tasks.add_task(process_video_generation, job_id, request, key)
     
     return JobResponse(job_id=job_id, status="pending")
 
 
-async def process_video_generation(job_id: str, request: VideoRequest):
+def get_video_wrapper(precision: str = "bf16", compile_model: bool = False) -> "LTXVideoWrapper":
+    """
+    Get the video wrapper, rebuilding it when the requested options change.
+    
+    Unloading and building wrappers blocks, so call it on a generation thread,
+    holding state.video_lock until done with the wrapper.
+    """
+    wrapper = state.video_wrapper
+    if wrapper and (wrapper.precision, wrapper.compile_model) != (precision, compile_model):
+        wrapper.unload(purge=True)
+        wrapper = None
+    
+    if wrapper is None:
+        wrapper = LTXVideoWrapper(
+            flashpack_path=downloader.get_flashpack_path(VIDEO_MODEL_ID),
+            precision=precision,
+            compile_model=compile_model,
+        )
+        state.video_wrapper = wrapper
+    return wrapper
+
+
+def unload_video_wrapper() -> None:
+    """Unload the video wrapper on a generation thread, after any running job."""
+    with state.video_lock:
+        if state.video_wrapper:
+            state.video_wrapper.unload(purge=True)
+            state.video_wrapper = None
+
+
+def warmup_video_wrapper() -> None:
+    """Warm up the default video wrapper on a generation thread."""
+    with state.video_lock:
+        get_video_wrapper().warmup()
+
+
+def run_video_generation(
+    config: "VideoGenerationConfig", precision: str, compile_model: bool
+) -> str:
+    """Generate a video on a generation thread, swapping the wrapper if needed."""
+    with state.video_lock:
+        return get_video_wrapper(precision, compile_model).generate_video(config)
+
+
+async def process_video_generation(job_id: str, request: VideoRequest, key: str):
     """Background task for video generation."""
     try:
-        state.jobs[job_id]["status"] = "processing"
-        
-        # Initialize wrapper if needed
-        if state.video_wrapper is None:
-            state.video_wrapper = LTXVideoWrapper()
+        await state.jobs.set(job_id, {"status": "processing"})
         
         # Generate video
         output_path = OUTPUT_DIR / f"{job_id}.mp4"
@@ -233,28 +526,35 @@ async def process_video_generation(job_id: str, request: VideoRequest):
             num_frames=request.num_frames,
             seed=request.seed,
             output_path=str(output_path),
+            cache_threshold=request.cache_threshold,
         )
         
-        # Run in thread pool
-        loop = asyncio.get_event_loop()
+        # Run in the generation thread pool
+        loop = asyncio.get_running_loop()
         result = await loop.run_in_executor(
-            None, state.video_wrapper.generate_video, config
+            state.gen_executor,
+            run_video_generation,
+            config,
+            request.precision,
+            request.compile,
         )
         
-        state.jobs[job_id] = {"status": "completed", "result": result}
+        await state.jobs.set(job_id, {"status": "completed", "result": result})
         
     except Exception as e:
         logger.exception(f"Video generation failed: {e}")
-        state.jobs[job_id] = {"status": "failed", "error": str(e)}
+        await state.jobs.set(job_id, {"status": "failed", "error": str(e)})
+    
+    finally:
+        state.inflight.pop(key, None)
 
 
 @app.get("/api/jobs/{job_id}", response_model=JobResponse)
 async def get_job_status(job_id: str):
     """Get the status of a generation job."""
-    if job_id not in state.jobs:
+    job = await state.jobs.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    
-    job = state.jobs[job_id]
     return JobResponse(
         job_id=job_id,
         status=job["status"],
@@ -263,14 +563,35 @@ async def get_job_status(job_id: str):
     )
 
 
+@app.get("/api/jobs/{job_id}/stream")
+async def stream_job_status(job_id: str):
+    """Stream job status updates as server-sent events until the job finishes."""
+    if await state.jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def events():
+        last = None
+        while True:
+            job = await state.jobs.get(job_id)
+            if job is None:
+                break
+            if job != last:
+                yield b"data: " + orjson.dumps({"job_id": job_id, **job}) + b"\n\n"
+                last = job
+            if job["status"] in ("completed", "failed"):
+                break
+            await asyncio.sleep(JOB_STREAM_INTERVAL)
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 @app.get("/api/download/{job_id}")
 async def download_result(job_id: str):
     """Download the generated file."""
-    if job_id not in state.jobs:
+    job = await state.jobs.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
     
-    job = state.jobs[job_id]
-    
     if job["status"] != "completed":
         raise HTTPException(status_code=400, detail=f"Job status: {job['status']}")
     
@@ -279,23 +600,34 @@ async def download_result(job_id: str):
     if not file_path.exists():
         raise HTTPException(status_code=404, detail="Generated file not found")
     
+    media_type = "image/png" if file_path.suffix == ".png" else "video/mp4"
+    
+    if ACCEL_REDIRECT_PREFIX:
+        return Response(
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX.rstrip('/')}/{file_path.name}",
+                "Content-Disposition": f'attachment; filename="{file_path.name}"',
+            },
+        )
+    
     return FileResponse(
         path=file_path,
         filename=file_path.name,
-        media_type="image/png" if file_path.suffix == ".png" else "video/mp4",
+        media_type=media_type,
     )
 
 
 @app.post("/api/models/unload")
 async def unload_models():
     """Unload all models to free memory."""
-    if state.video_wrapper:
-        state.video_wrapper.unload()
-        state.video_wrapper = None
+    if state.gen_executor:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(state.gen_executor, unload_video_wrapper)
     
-    if state.image_wrapper:
-        state.image_wrapper.unload()
-        state.image_wrapper = None
+    for index in range(len(state.image_executors)):
+        await run_in_image_worker(index, unload_image_worker)
+        state.image_worker_info[index] = {}
     
     return {"message": "All models unloaded"}
 
@@ -305,7 +637,9 @@ async def get_models_info():
     """Get information about loaded models."""
     return {
         "video": state.video_wrapper.get_model_info() if state.video_wrapper else None,
-        "image": state.image_wrapper.get_model_info() if state.image_wrapper else None,
+        "image": {
+            f"worker_{index}": info for index, info in enumerate(state.image_worker_info)
+        },
     }
 
 
@@ -315,8 +649,26 @@ def main():
     
     port = int(os.environ.get("AMFBOT_MEDIA_PORT", 8765))
     host = os.environ.get("AMFBOT_MEDIA_HOST", "0.0.0.0")
+    workers = int(os.environ.get("AMFBOT_WORKERS", 1))
     
-    uvicorn.run(app, host=host, port=port)
+    if workers > 1:
+        # Jobs are shared through SQLite, but GPU pools and wrappers are not
+        logger.warning(
+            f"Running {workers} server workers: each one starts its own image worker "
+            "processes and video wrapper, loading its own copy of the models"
+        )
+    
+    # An import string is required for multiple workers
+    uvicorn.run(
+        "api.server:app",
+        host=host,
+        port=port,
+        # uvloop when installed (not on Windows), asyncio otherwise
+        loop="auto",
+        http="httptools",
+        workers=workers,
+        log_level="info",
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+"""
+AMFbot Media Generation Workers
+
+Process-pool workers for image generation:
+- One worker process per visible GPU
+- Flux wrappers stay resident in the worker between jobs
+- PNG encoding runs outside the API process
+
+License: Apache-2.0
+"""
+
+import os
+import logging
+from collections import OrderedDict
+from typing import Optional, List, Tuple
+
+from downloader import ModelDownloader
+from api.cuda_pool import reserve_cuda_memory
+from image.flux_wrapper import FluxWrapper, ImageGenerationConfig
+
+logger = logging.getLogger(__name__)
+
+# Downloader model IDs for each Flux variant
+IMAGE_MODEL_IDS = {"schnell": "flux-schnell", "dev": "flux-dev"}
+IMAGE_LRU_CAP = int(os.environ.get("AMFBOT_IMAGE_LRU", 2))
+
+# Worker process state
+_downloader: Optional[ModelDownloader] = None
+# Loaded Flux wrappers keyed on their options, least recently used first
+_image_wrappers: "OrderedDict[str, FluxWrapper]" = OrderedDict()
+
+
+def init_image_worker(gpu_index: Optional[int]) -> None:
+    """
+    Initialize an image worker process.
+    
+    Args:
+        gpu_index: Index of the GPU this worker owns, or None without CUDA
+    """
+    global _downloader
+    
+    logging.basicConfig(level=logging.INFO)
+    
+    # Pin the worker to its GPU before CUDA is initialized, so "cuda" in
+    # this process always refers to the owned device
+    if gpu_index is not None:
+        visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+        devices = visible.split(",") if visible else [str(i) for i in range(gpu_index + 1)]
+        os.environ["CUDA_VISIBLE_DEVICES"] = devices[gpu_index]
+    
+    reserve_cuda_memory()
+    
+    _downloader = ModelDownloader()
+    logger.info(f"Image worker started (pid={os.getpid()}, gpu={gpu_index})")
+
+
+def _free_vram_gb() -> float:
+    """Get free VRAM on the current CUDA device in GB (unbounded without CUDA)."""
+    import torch
+    
+    if not torch.cuda.is_available():
+        return float("inf")
+    free, _ = torch.cuda.mem_get_info()
+    return free / (1024 ** 3)
+
+
+def _evict_image_wrapper() -> None:
+    """Unload the least recently used Flux wrapper."""
+    evicted_key, evicted = _image_wrappers.popitem(last=False)
+    evicted.unload(purge=True)
+    logger.info(f"Evicted Flux wrapper: {evicted_key}")
+
+
+def get_image_wrapper(
+    variant: str,
+    precision: str = "bf16",
+    compile_model: bool = False,
+) -> FluxWrapper:
+    """
+    Get the Flux wrapper for a configuration from the LRU cache.
+    
+    On a miss, the least recently used wrappers are unloaded until the cache
+    is below its cap. A new wrapper that keeps its whole pipeline on the GPU
+    also unloads wrappers until its footprint fits in free VRAM; offloaded
+    wrappers mostly live in CPU memory and evict nothing for VRAM.
+    """
+    key = f"{variant}:{precision}" + (":compiled" if compile_model else "")
+    if key in _image_wrappers:
+        _image_wrappers.move_to_end(key)
+        return _image_wrappers[key]
+    
+    while _image_wrappers and len(_image_wrappers) >= IMAGE_LRU_CAP:
+        _evict_image_wrapper()
+    
+    model_id = IMAGE_MODEL_IDS[variant]
+    wrapper = FluxWrapper(
+        model_variant=variant,
+        flashpack_path=_downloader.get_flashpack_path(model_id),
+        npcache_dir=_downloader.get_npcache_dir(model_id),
+        precision=precision,
+        compile_model=compile_model,
+    )
+    
+    # Same precision-scaled footprint the wrapper picked its offload mode from
+    if wrapper.cpu_offload == "none":
+        while _image_wrappers and _free_vram_gb() < wrapper.footprint_gb:
+            _evict_image_wrapper()
+    
+    _image_wrappers[key] = wrapper
+    return wrapper
+
+
+def preload_image_worker(variants: List[str]) -> dict:
+    """
+    Load and warm up wrappers ahead of the first request.
+    
+    Args:
+        variants: Flux model variants to preload
+    
+    Returns:
+        The worker's loaded wrappers
+    """
+    for variant in variants:
+        get_image_wrapper(variant).warmup()
+    return get_image_worker_info()
+
+
+def get_image_worker_capability() -> Optional[Tuple[int, int]]:
+    """Get the CUDA compute capability of this worker's GPU, or None without CUDA."""
+    import torch
+    
+    if not torch.cuda.is_available():
+        return None
+    return torch.cuda.get_device_capability()
+
+
+def get_image_worker_info() -> dict:
+    """Get information about the wrappers loaded in this worker."""
+    return {key: wrapper.get_model_info() for key, wrapper in _image_wrappers.items()}
+
+
+def run_image_job(
+    variant: str,
+    config: dict,
+    precision: str = "bf16",
+    compile_model: bool = False,
+) -> dict:
+    """
+    Run an image generation job in the worker.
+    
+    Args:
+        variant: Flux model variant
+        config: ImageGenerationConfig fields
+        precision: Transformer weight precision
+        compile_model: Compile the transformer with torch.compile
+    
+    Returns:
+        Dict with the first output path and the worker's loaded wrappers
+    """
+    wrapper = get_image_wrapper(variant, precision, compile_model)
+    result = wrapper.generate_image(ImageGenerationConfig(**config))
+    
+    return {
+        "result": result if isinstance(result, str) else result[0],
+        "loaded": get_image_worker_info(),
+    }
+
+
+def unload_image_worker() -> None:
+    """Unload all wrappers held by this worker."""
+    for wrapper in _image_wrappers.values():
+        wrapper.unload(purge=True)
+    _image_wrappers.clear()
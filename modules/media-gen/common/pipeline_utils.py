@@ -0,0 +1,361 @@
+"""
+AMFbot Pipeline Utilities
+
+Helpers shared by the Flux and LTX-Video wrappers:
+- Device, dtype and CPU offload selection
+- Transformer loading from bitsandbytes or FlashPack and FP8 quantization
+- Pipeline placement, VAE tiling, attention backends and torch.compile
+- First-block cache settings of pipelines shared between wrappers
+- Automatic model weight downloading
+
+License: Apache-2.0
+"""
+
+import os
+import logging
+import importlib.util
+from pathlib import Path
+from typing import Optional
+
+import torch
+from diffusers import BitsAndBytesConfig, FirstBlockCacheConfig
+from huggingface_hub import constants as hf_constants, snapshot_download
+
+logger = logging.getLogger(__name__)
+
+# Use the Rust hf_transfer backend when installed, unless AMFBOT_HF_TRANSFER=0.
+# Set on the constants module, since huggingface_hub may already be imported.
+if importlib.util.find_spec("hf_transfer") and os.environ.get("AMFBOT_HF_TRANSFER") != "0":
+    hf_constants.HF_HUB_ENABLE_HF_TRANSFER = True
+
+# Parallel file downloads and metadata timeout for flaky networks
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_ETAG_TIMEOUT = 30
+# diffusers attention backend for the transformer (default: native SDPA)
+ATTENTION_BACKEND = os.environ.get("AMFBOT_ATTENTION_BACKEND") or None
+# torch.compile modes that capture CUDA graphs
+CUDAGRAPH_MODES = ("reduce-overhead", "max-autotune")
+# Offload modes: auto keeps the pipeline on the GPU when it fits in free VRAM
+OFFLOAD_MODES = ("auto", "none", "model", "sequential")
+# Free VRAM required over the footprint to run without offload
+OFFLOAD_HEADROOM = 1.3
+# Transformer precisions loaded through bitsandbytes, which places the weights itself
+BNB_PRECISIONS = ("nf4", "int8")
+
+
+def mark_cudagraph_step(pipeline, step: int, timestep, callback_kwargs: dict) -> dict:
+    """
+    Step callback starting a new CUDA graph step after each denoising step.
+    
+    Compiled CUDA graphs reuse their output buffers on replay, so marking the
+    step lets the next replay overwrite the previous step's outputs safely.
+    """
+    torch.compiler.cudagraph_mark_step_begin()
+    return callback_kwargs
+
+
+def detect_device() -> str:
+    """Detect the best available device."""
+    if torch.cuda.is_available():
+        return "cuda"
+    elif torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def optimal_dtype(device: str) -> torch.dtype:
+    """Get optimal dtype for a device."""
+    if device == "cuda":
+        # Use bfloat16 for newer GPUs
+        if torch.cuda.is_bf16_supported():
+            return torch.bfloat16
+        return torch.float16
+    elif device == "mps":
+        return torch.float16
+    return torch.float32
+
+
+def resolve_offload(mode: str, device: str, footprint_gb: float) -> str:
+    """
+    Resolve the CPU offload mode, choosing one from free VRAM in auto mode.
+    
+    Args:
+        mode: auto, none, model or sequential
+        device: Device the pipeline runs on
+        footprint_gb: Approximate VRAM footprint of the whole pipeline
+    """
+    if mode not in OFFLOAD_MODES:
+        raise ValueError(f"Unknown offload mode: {mode}. Choose from: {list(OFFLOAD_MODES)}")
+    if device != "cuda":
+        return "none"
+    if mode != "auto":
+        return mode
+    
+    free, _ = torch.cuda.mem_get_info()
+    required_gb = footprint_gb * OFFLOAD_HEADROOM
+    if free / (1024 ** 3) > required_gb:
+        return "none"
+    
+    logger.info(f"Free VRAM below {required_gb:.0f}GB, using model CPU offload")
+    return "model"
+
+
+def weights_device(device: str, cpu_offload: str) -> str:
+    """Get the device to load weights onto."""
+    # Offloaded pipelines manage placement themselves, so keep weights on CPU
+    return "cpu" if cpu_offload != "none" else device
+
+
+def direct_device_map(device: str, cpu_offload: str) -> Optional[str]:
+    """
+    Get the from_pretrained device map of a pipeline kept on the GPU, if any.
+    
+    Without offload, the safetensors stream straight onto the GPU instead of
+    materializing a CPU copy first.
+    """
+    return "cuda" if device == "cuda" and cpu_offload == "none" else None
+
+
+def download_snapshot(repo_id: str, models_dir: Path) -> Path:
+    """Download a model repo into models_dir unless it is already there."""
+    if not models_dir.exists():
+        logger.info(f"Downloading model: {repo_id}")
+        snapshot_download(
+            repo_id=repo_id,
+            local_dir=models_dir,
+            ignore_patterns=["*.md", "*.txt"],
+            max_workers=DOWNLOAD_WORKERS,
+            etag_timeout=DOWNLOAD_ETAG_TIMEOUT,
+        )
+        logger.info("Model download complete")
+    
+    return models_dir
+
+
+def load_flashpack_transformer(
+    model_cls,
+    model_id: str,
+    flashpack_path: Path,
+    device: str,
+    dtype: torch.dtype,
+    cpu_offload: str,
+):
+    """
+    Build a transformer skeleton and stream its weights from FlashPack.
+    
+    Args:
+        model_cls: diffusers transformer class
+        model_id: HuggingFace model ID holding the transformer config
+        flashpack_path: FlashPack file of the transformer weights
+        device: Device the pipeline runs on
+        dtype: Model precision
+        cpu_offload: Resolved CPU offload mode of the pipeline
+    """
+    from accelerate import init_empty_weights
+    from flashpack import assign_from_file
+    
+    logger.info(f"Loading transformer from FlashPack: {flashpack_path}")
+    
+    config = model_cls.load_config(model_id, subfolder="transformer")
+    with init_empty_weights():
+        transformer = model_cls.from_config(config)
+    
+    device = weights_device(device, cpu_offload)
+    assign_from_file(transformer, str(flashpack_path), device=device)
+    
+    return transformer.to(dtype)
+
+
+def transformer_components(
+    model_cls,
+    model_id: str,
+    precision: str,
+    flashpack_path: Optional[Path],
+    device: str,
+    dtype: torch.dtype,
+    cpu_offload: str,
+) -> dict:
+    """
+    Get a preloaded transformer to pass to from_pretrained, if any.
+    
+    Args:
+        model_cls: diffusers transformer class
+        model_id: HuggingFace model ID
+        precision: Transformer weight precision
+        flashpack_path: Optional FlashPack file of the transformer weights
+        device: Device the pipeline runs on
+        dtype: Model precision
+        cpu_offload: Resolved CPU offload mode of the pipeline
+    """
+    if precision in BNB_PRECISIONS:
+        if precision == "nf4":
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=dtype,
+            )
+        else:
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        transformer = model_cls.from_pretrained(
+            model_id,
+            subfolder="transformer",
+            quantization_config=quantization_config,
+            torch_dtype=dtype,
+        )
+        return {"transformer": transformer}
+    
+    # FlashPack files hold unquantized weights
+    if flashpack_path is not None:
+        transformer = load_flashpack_transformer(
+            model_cls, model_id, flashpack_path, device, dtype, cpu_offload
+        )
+        return {"transformer": transformer}
+    
+    return {}
+
+
+def quantize_fp8(transformer: torch.nn.Module) -> None:
+    """Quantize transformer weights to FP8 in place."""
+    from optimum.quanto import freeze, qfloat8, quantize
+    
+    logger.info("Quantizing transformer to FP8...")
+    quantize(transformer, weights=qfloat8)
+    freeze(transformer)
+
+
+def set_attention_backend(transformer, backend: str) -> None:
+    """Switch the transformer's attention kernels, falling back to native SDPA."""
+    try:
+        transformer.set_attention_backend(backend)
+        logger.info(f"Using {backend} attention")
+    except Exception as e:
+        logger.warning(f"Attention backend {backend} unavailable ({e})")
+
+
+def prepare_pipeline(
+    pipeline,
+    device: str,
+    cpu_offload: str,
+    placed: bool,
+    vae_memory_format: torch.memory_format,
+    attention_backend: Optional[str],
+):
+    """
+    Place a loaded pipeline and set up its VAE and attention kernels.
+    
+    Args:
+        pipeline: diffusers pipeline with transformer and vae components
+        device: Device the pipeline runs on
+        cpu_offload: Resolved CPU offload mode of the pipeline
+        placed: Whether from_pretrained already placed the weights with a device map
+        vae_memory_format: Channels-last memory format of the VAE's convolutions
+        attention_backend: Optional diffusers attention backend
+    
+    Returns:
+        The placed pipeline
+    """
+    if cpu_offload == "model":
+        pipeline.enable_model_cpu_offload()
+    elif cpu_offload == "sequential":
+        pipeline.enable_sequential_cpu_offload()
+    elif not placed:
+        pipeline = pipeline.to(device)
+    
+    # Decode in tiles and one sample at a time, so peak VAE memory no
+    # longer grows with resolution and batch size
+    pipeline.vae.enable_tiling()
+    pipeline.vae.enable_slicing()
+    
+    if device == "cuda":
+        # Channels-last lets cuDNN pick its tensor-core conv kernels for the VAE
+        pipeline.vae.to(memory_format=vae_memory_format)
+    
+    if attention_backend:
+        set_attention_backend(pipeline.transformer, attention_backend)
+    
+    return pipeline
+
+
+def cudagraph_step_callback(pipeline, compile_mode: str):
+    """Get the step callback a pipeline needs, if its transformer runs CUDA graphs."""
+    # Compiled modules keep the original under _orig_mod
+    compiled = hasattr(pipeline.transformer, "_orig_mod")
+    return mark_cudagraph_step if compiled and compile_mode in CUDAGRAPH_MODES else None
+
+
+def set_first_block_cache(transformer, current: float, threshold: float) -> float:
+    """
+    Enable, retune or disable the first-block cache on a transformer.
+    
+    The cache reuses the previous step's output when the residual of the
+    first transformer block changes less than the threshold.
+    
+    Args:
+        transformer: diffusers transformer
+        current: Threshold last set on it by the calling wrapper (0 = off)
+        threshold: New threshold (0 = off)
+    
+    Returns:
+        The threshold now set
+    """
+    if threshold == current:
+        return current
+    
+    # Another wrapper sharing the cached pipeline may have enabled it
+    if transformer.is_cache_enabled:
+        transformer.disable_cache()
+    if threshold > 0:
+        transformer.enable_cache(FirstBlockCacheConfig(threshold=threshold))
+    
+    return threshold
+
+
+def restore_pipeline_defaults(pipeline, cache_threshold: float, set_vae_tile_size) -> None:
+    """
+    Hand a cached pipeline back with its default settings for the next wrapper.
+    
+    Args:
+        pipeline: Pipeline shared through a wrapper's pipeline cache
+        cache_threshold: First-block cache threshold the wrapper set on it
+        set_vae_tile_size: Wrapper method restoring the default VAE tiles for None
+    """
+    set_first_block_cache(pipeline.transformer, cache_threshold, 0.0)
+    set_vae_tile_size(pipeline, None)
+
+
+def compile_pipeline(
+    pipeline,
+    device: str,
+    cpu_offload: str,
+    mode: str,
+    cache_dir: Path,
+    compile_transformer: bool = True,
+) -> None:
+    """
+    Compile a pipeline's transformer and VAE decoder, caching graphs across restarts.
+    
+    Args:
+        pipeline: diffusers pipeline with transformer and vae components
+        device: Device the pipeline runs on
+        cpu_offload: Resolved CPU offload mode of the pipeline
+        mode: torch.compile mode
+        cache_dir: Directory of the persistent Inductor graph cache
+        compile_transformer: Compile the transformer as well as the VAE decoder
+    """
+    if device != "cuda":
+        logger.warning(f"Skipping torch.compile: not supported on {device}")
+        return
+    if cpu_offload != "none":
+        # Offload hooks move weights between steps, which breaks CUDA graphs
+        logger.warning("Skipping torch.compile: not supported with CPU offload")
+        return
+    
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", str(cache_dir))
+    torch._inductor.config.fx_graph_cache = True
+    
+    if compile_transformer:
+        logger.info(f"Compiling transformer ({mode})...")
+        pipeline.transformer = torch.compile(pipeline.transformer, mode=mode, fullgraph=False)
+    
+    logger.info(f"Compiling VAE decoder ({mode})...")
+    pipeline.vae.decode = torch.compile(pipeline.vae.decode, mode=mode)
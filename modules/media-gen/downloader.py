@@ -6,25 +6,62 @@ Asynchronous download manager for AI model weights:
 - Flux.1 models
 - Progress tracking
 - Resume support
+- Symlinks into the HuggingFace cache (no duplicate copies)
 
 License: Apache-2.0
 """
 
 import os
+import json
+import time
 import asyncio
 import hashlib
 import logging
 from pathlib import Path
-from typing import Optional, Callable, List
+from typing import Optional, Callable, Dict, List
 from dataclasses import dataclass
-from concurrent.futures import ThreadPoolExecutor
 
-from huggingface_hub import hf_hub_download, snapshot_download
+import aiofiles
+import httpx
+from huggingface_hub import HfApi, hf_hub_url, scan_cache_dir
+from huggingface_hub.constants import HF_HUB_CACHE
+from huggingface_hub.file_download import repo_folder_name
+from huggingface_hub.utils import build_hf_headers, filter_repo_objects
 from tqdm import tqdm
 
+# Optional FlashPack support for fast cold-start weight loading
+try:
+    import torch
+    from flashpack import pack_to_file
+    from safetensors.torch import load_file
+    HAS_FLASHPACK = True
+except ImportError:
+    HAS_FLASHPACK = False
+
 logger = logging.getLogger(__name__)
 
 MODELS_DIR = Path(os.environ.get("AMFBOT_MODELS_DIR", "./models"))
+FLASHPACK_FILENAME = "model.flashpack"
+NPCACHE_DIRNAME = "npcache"
+MARKER_FILENAME = ".download_complete"
+DOWNLOAD_RETRIES = int(os.environ.get("AMFBOT_DOWNLOAD_RETRIES", 3))
+PROGRESS_INTERVAL = 0.5  # seconds between progress updates
+CHUNK_SIZE = 1024 * 1024  # bytes per streamed read
+DOWNLOAD_TIMEOUT = 30.0  # seconds without data before a request fails
+MAX_CONNECTIONS = 16  # HTTP/2 multiplexes file streams over these
+
+# Convert text encoder and VAE weights to memory-mappable numpy files
+USE_NPCACHE = os.environ.get("AMFBOT_NPCACHE") == "1"
+NPCACHE_COMPONENTS = ("text_encoder", "text_encoder_2", "vae")
+
+# Link model directories to files in the HuggingFace cache instead of copying
+# them. Windows needs extra privileges for symlinks, so copy there.
+USE_SYMLINKS = os.name != "nt"
+
+# Only fetch safetensors weights, configs and tokenizer files; repos that also
+# ship PyTorch .bin duplicates would otherwise double the transfer.
+ALLOW_PATTERNS = ["*.safetensors", "*.json", "*.model", "*.txt"]
+IGNORE_PATTERNS = ["*.md", "*.bin", "*.pt", "*.ckpt"]
 
 
 @dataclass
@@ -80,6 +117,9 @@ AVAILABLE_MODELS: List[ModelInfo] = [
     ),
 ]
 
+# Model lookup by ID
+_MODELS_BY_ID: Dict[str, ModelInfo] = {m.id: m for m in AVAILABLE_MODELS}
+
 
 @dataclass
 class DownloadProgress:
@@ -112,12 +152,13 @@ class ModelDownloader:
         
         Args:
             models_dir: Directory to store downloaded models
-            max_concurrent: Maximum concurrent downloads
+            max_concurrent: Download concurrency (four file streams per slot)
         """
         self.models_dir = models_dir or MODELS_DIR
         self.models_dir.mkdir(parents=True, exist_ok=True)
         self.max_concurrent = max_concurrent
-        self._executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        # File streams in flight across all models being downloaded
+        self._semaphore = asyncio.Semaphore(max_concurrent * 4)
         self._active_downloads: dict = {}
     
     def get_available_models(self) -> List[ModelInfo]:
@@ -126,10 +167,7 @@ class ModelDownloader:
     
     def get_model_info(self, model_id: str) -> Optional[ModelInfo]:
         """Get information about a specific model."""
-        for model in AVAILABLE_MODELS:
-            if model.id == model_id:
-                return model
-        return None
+        return _MODELS_BY_ID.get(model_id)
     
     def is_downloaded(self, model_id: str) -> bool:
         """Check if a model is already downloaded."""
@@ -139,9 +177,37 @@ class ModelDownloader:
         
         model_dir = self.models_dir / model.type / model_id
         
-        # Check for marker file
-        marker = model_dir / ".download_complete"
-        return marker.exists()
+        # Check for marker file and that the files on disk still match it
+        marker = model_dir / MARKER_FILENAME
+        if not marker.exists():
+            return False
+        if marker.read_text().strip() != self._compute_manifest_hash(model_dir):
+            logger.warning(f"Model {model_id} files changed since download")
+            return False
+        
+        # Diffusers repos must also have been packed when FlashPack is installed
+        if HAS_FLASHPACK and (model_dir / "transformer").is_dir():
+            return (model_dir / FLASHPACK_FILENAME).exists()
+        
+        return True
+    
+    def get_npcache_dir(self, model_id: str) -> Optional[Path]:
+        """Get the numpy weight cache of a downloaded model, if one exists."""
+        model = self.get_model_info(model_id)
+        if not model:
+            return None
+        
+        path = self.models_dir / model.type / model_id / NPCACHE_DIRNAME
+        return path if path.is_dir() else None
+    
+    def get_flashpack_path(self, model_id: str) -> Optional[Path]:
+        """Get the FlashPack file for a downloaded model, if one exists."""
+        model = self.get_model_info(model_id)
+        if not model:
+            return None
+        
+        path = self.models_dir / model.type / model_id / FLASHPACK_FILENAME
+        return path if path.exists() else None
     
     async def download_model(
         self,
@@ -187,52 +253,332 @@ class ModelDownloader:
         self._active_downloads[model_id] = progress
         
         try:
-            # Run download in thread pool
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(
-                self._executor,
-                self._download_sync,
-                model,
-                model_dir,
-                progress,
-                progress_callback,
-            )
-            
-            # Create marker file
-            marker = model_dir / ".download_complete"
-            marker.write_text(model.repo_id)
-            
+            result = await self._download(model, model_dir, progress, progress_callback)
             logger.info(f"Download complete: {model.name}")
             return result
             
         finally:
             del self._active_downloads[model_id]
     
-    def _download_sync(
+    async def _download(
         self,
         model: ModelInfo,
         model_dir: Path,
         progress: DownloadProgress,
         callback: Optional[Callable],
     ) -> Path:
-        """Synchronous download with progress tracking."""
+        """Stream all repo files concurrently, then post-process the snapshot."""
+        info = await asyncio.to_thread(
+            HfApi().model_info, model.repo_id, files_metadata=True
+        )
+        files = list(filter_repo_objects(
+            info.siblings,
+            allow_patterns=ALLOW_PATTERNS,
+            ignore_patterns=IGNORE_PATTERNS,
+            key=lambda f: f.rfilename,
+        ))
+        
+        repo_cache = Path(HF_HUB_CACHE) / repo_folder_name(repo_id=model.repo_id, repo_type="model")
+        if USE_SYMLINKS:
+            # Download blobs into the HF cache layout; identical files share a
+            # content-addressed blob, so each is fetched once
+            targets = {}
+            for file in files:
+                targets.setdefault(self._blob_path(repo_cache, file), file)
+        else:
+            targets = {model_dir / file.rfilename: file for file in files}
+        # Count what is actually fetched, so duplicate blobs don't hold progress below 100%
+        progress.total_bytes = sum(f.size or 0 for f in targets.values())
+        progress.files_total = len(targets)
         
-        def update_progress(current: int, total: int, filename: str):
-            progress.downloaded_bytes = current
-            progress.total_bytes = total
-            progress.current_file = filename
-            if callback:
+        last_report = 0.0
+        
+        def report() -> None:
+            nonlocal last_report
+            now = time.monotonic()
+            if callback and now - last_report >= PROGRESS_INTERVAL:
+                last_report = now
                 callback(progress)
         
-        # Download using huggingface_hub
-        snapshot_download(
-            repo_id=model.repo_id,
-            local_dir=model_dir,
-            ignore_patterns=["*.md", "*.txt", "*.json"],
-        )
+        async with httpx.AsyncClient(
+            http2=True,
+            headers=build_hf_headers(),
+            follow_redirects=True,
+            timeout=DOWNLOAD_TIMEOUT,
+            limits=httpx.Limits(max_connections=MAX_CONNECTIONS),
+        ) as client:
+            await asyncio.gather(*(
+                self._download_file(client, model.repo_id, info.sha, file, dest, progress, report)
+                for dest, file in targets.items()
+            ))
+        
+        progress.current_file = ""
+        if callback:
+            callback(progress)
         
+        # Linking and weight conversion are blocking, keep them off the event loop
+        await asyncio.to_thread(self._finalize, model, model_dir, repo_cache, info.sha, files)
         return model_dir
     
+    async def _download_file(
+        self,
+        client: httpx.AsyncClient,
+        repo_id: str,
+        revision: str,
+        file,
+        dest: Path,
+        progress: DownloadProgress,
+        report: Callable[[], None],
+    ) -> None:
+        """
+        Stream one repo file to disk, resuming partial downloads.
+        
+        Bytes are written to a .incomplete file first. Retries send a Range
+        request for the remainder, so a failed attempt never starts over.
+        The finished file must match the size and content hash in the repo
+        metadata before it replaces dest.
+        """
+        async with self._semaphore:
+            if dest.exists() and dest.stat().st_size == file.size:
+                progress.downloaded_bytes += file.size
+                progress.files_completed += 1
+                return
+            
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            if file.size == 0:
+                # Empty bodies never create the .incomplete file
+                dest.write_bytes(b"")
+                progress.files_completed += 1
+                return
+            
+            tmp = dest.with_name(dest.name + ".incomplete")
+            url = hf_hub_url(repo_id, file.rfilename, revision=revision)
+            counted = 0  # bytes of this file already included in progress
+            
+            for attempt in range(1, DOWNLOAD_RETRIES + 1):
+                offset = tmp.stat().st_size if tmp.exists() else 0
+                progress.downloaded_bytes += offset - counted
+                counted = offset
+                
+                try:
+                    if offset < file.size:
+                        headers = {"Range": f"bytes={offset}-"} if offset else None
+                        async with client.stream("GET", url, headers=headers) as response:
+                            if response.status_code == 416:
+                                # The partial file doesn't fit the remote one, start over
+                                tmp.unlink(missing_ok=True)
+                                raise OSError("requested range not satisfiable")
+                            response.raise_for_status()
+                            if offset and response.status_code != 206:
+                                # Server ignored the range, start the file over
+                                progress.downloaded_bytes -= offset
+                                counted = offset = 0
+                            
+                            async with aiofiles.open(tmp, "ab" if offset else "wb") as f:
+                                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                                    await f.write(chunk)
+                                    progress.downloaded_bytes += len(chunk)
+                                    counted += len(chunk)
+                                    progress.current_file = file.rfilename
+                                    report()
+                    
+                    # A stream can end early without an error; the next attempt resumes it
+                    size = tmp.stat().st_size
+                    if size < file.size:
+                        raise OSError(f"stream ended at {size} of {file.size} bytes")
+                    if size > file.size or not await asyncio.to_thread(
+                        self._content_matches, tmp, file
+                    ):
+                        tmp.unlink()
+                        raise OSError("content does not match the repo's hash")
+                    break
+                except (httpx.HTTPError, OSError) as e:
+                    if attempt == DOWNLOAD_RETRIES:
+                        raise
+                    delay = 2 ** attempt
+                    logger.warning(
+                        f"Download of {repo_id}/{file.rfilename} failed ({e}), "
+                        f"retrying in {delay}s ({attempt}/{DOWNLOAD_RETRIES})"
+                    )
+                    await asyncio.sleep(delay)
+            
+            os.replace(tmp, dest)
+            progress.files_completed += 1
+    
+    @staticmethod
+    def _content_matches(path: Path, file) -> bool:
+        """Check a downloaded file against the content hash its blob is named by."""
+        if file.lfs:
+            digest, expected = hashlib.sha256(), file.lfs.sha256
+        else:
+            # Git blob IDs hash a size header followed by the content
+            digest, expected = hashlib.sha1(f"blob {file.size}\0".encode()), file.blob_id
+        
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest() == expected
+    
+    @staticmethod
+    def _blob_path(repo_cache: Path, file) -> Path:
+        """Get the HF cache blob of a repo file, named by its content hash."""
+        return repo_cache / "blobs" / (file.lfs.sha256 if file.lfs else file.blob_id)
+    
+    def _finalize(
+        self, model: ModelInfo, model_dir: Path, repo_cache: Path, revision: str, files: list
+    ) -> None:
+        """Link, convert and mark a fully downloaded model."""
+        if USE_SYMLINKS:
+            snapshot_dir = self._write_snapshot(repo_cache, revision, files)
+            self._link_snapshot(snapshot_dir, model_dir)
+        
+        if HAS_FLASHPACK:
+            self._convert_to_flashpack(model_dir)
+        
+        # Only the Flux wrapper reads the npcache
+        if USE_NPCACHE and model.type == "image":
+            self._write_npcache(model_dir)
+        
+        self._write_marker(model_dir)
+    
+    def _write_snapshot(self, repo_cache: Path, revision: str, files: list) -> Path:
+        """
+        Create the HF cache snapshot of downloaded blobs.
+        
+        Mirrors huggingface_hub's layout (snapshots/<sha> of relative links
+        into blobs/, refs/main) so from_pretrained on the repo ID reuses them.
+        """
+        snapshot_dir = repo_cache / "snapshots" / revision
+        for file in files:
+            link = snapshot_dir / file.rfilename
+            link.parent.mkdir(parents=True, exist_ok=True)
+            if link.is_symlink() or link.exists():
+                link.unlink()
+            link.symlink_to(os.path.relpath(self._blob_path(repo_cache, file), link.parent))
+        
+        refs = repo_cache / "refs"
+        refs.mkdir(parents=True, exist_ok=True)
+        (refs / "main").write_text(revision)
+        return snapshot_dir
+    
+    def _link_snapshot(self, snapshot_dir: Path, model_dir: Path) -> None:
+        """Mirror a cached snapshot into model_dir as symlinks to its blobs."""
+        for src in snapshot_dir.rglob("*"):
+            if src.is_dir():
+                continue
+            dest = model_dir / src.relative_to(snapshot_dir)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            if dest.is_symlink() or dest.exists():
+                dest.unlink()
+            dest.symlink_to(os.path.realpath(src))
+    
+    def _compute_manifest_hash(self, model_dir: Path) -> str:
+        """Hash the relative path and size of every file in a model directory."""
+        manifest = []
+        for path in model_dir.rglob("*"):
+            if not path.is_file():
+                continue
+            relative = path.relative_to(model_dir)
+            # Skip huggingface_hub's download metadata and the marker itself
+            if relative.parts[0] == ".cache" or relative.name.startswith(MARKER_FILENAME):
+                continue
+            manifest.append((relative.as_posix(), path.stat().st_size))
+        
+        manifest.sort()
+        return hashlib.blake2b(json.dumps(manifest).encode()).hexdigest()
+    
+    def _write_marker(self, model_dir: Path) -> None:
+        """Atomically write the completion marker with the manifest hash."""
+        marker = model_dir / MARKER_FILENAME
+        tmp = marker.with_name(MARKER_FILENAME + ".tmp")
+        tmp.write_text(self._compute_manifest_hash(model_dir))
+        os.replace(tmp, marker)
+    
+    def _write_npcache(self, model_dir: Path) -> None:
+        """
+        Convert text encoder and VAE weights to memory-mappable .npy files.
+        
+        Each component gets npcache/{component}/ with one .npy per tensor and
+        an index.json mapping tensor names to file, dtype and shape. numpy has
+        no bfloat16, so those tensors are stored as their raw int16 bits.
+        
+        Args:
+            model_dir: Directory of the downloaded snapshot
+        """
+        import torch
+        from numpy.lib.format import open_memmap
+        from safetensors import safe_open
+        
+        for component in NPCACHE_COMPONENTS:
+            shards = sorted((model_dir / component).glob("*.safetensors"))
+            cache_dir = model_dir / NPCACHE_DIRNAME / component
+            index_path = cache_dir / "index.json"
+            if not shards or index_path.exists():
+                continue
+            
+            logger.info(f"Writing npcache for {component}...")
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            
+            index = {}
+            for shard in shards:
+                with safe_open(str(shard), framework="pt") as f:
+                    for key in f.keys():
+                        tensor = f.get_tensor(key)
+                        dtype = str(tensor.dtype).removeprefix("torch.")
+                        if tensor.dtype == torch.bfloat16:
+                            tensor = tensor.view(torch.int16)
+                        
+                        data = tensor.numpy()
+                        filename = f"{len(index):05d}.npy"
+                        array = open_memmap(
+                            cache_dir / filename, mode="w+", dtype=data.dtype, shape=data.shape
+                        )
+                        array[...] = data
+                        array.flush()
+                        del array
+                        
+                        index[key] = {"file": filename, "dtype": dtype, "shape": list(data.shape)}
+            
+            # Written last so an interrupted conversion is never used
+            index_path.write_text(json.dumps(index))
+    
+    def _convert_to_flashpack(self, model_dir: Path) -> Optional[Path]:
+        """
+        Pack the transformer weights of a diffusers repo into a FlashPack file.
+        
+        The transformer dominates cold-start time, so it is flattened once into
+        contiguous per-dtype blocks that can be streamed straight to the GPU.
+        
+        Args:
+            model_dir: Directory of the downloaded snapshot
+            
+        Returns:
+            Path to the FlashPack file, or None if the repo has no transformer
+        """
+        transformer_dir = model_dir / "transformer"
+        shards = sorted(transformer_dir.glob("*.safetensors"))
+        if not shards:
+            logger.info(f"No transformer weights in {model_dir}, skipping FlashPack")
+            return None
+        
+        output_path = model_dir / FLASHPACK_FILENAME
+        if output_path.exists():
+            return output_path
+        
+        logger.info(f"Converting {transformer_dir} to FlashPack...")
+        
+        state_dict = {}
+        for shard in shards:
+            state_dict.update(load_file(str(shard)))
+        
+        # Write to a temporary file so an interrupted conversion is never picked up
+        tmp_path = output_path.with_suffix(".tmp")
+        pack_to_file(state_dict, str(tmp_path), target_dtype=torch.bfloat16)
+        os.replace(tmp_path, output_path)
+        
+        logger.info(f"FlashPack written to {output_path}")
+        return output_path
+    
     async def download_all(
         self,
         model_ids: Optional[List[str]] = None,
@@ -289,38 +635,67 @@ class ModelDownloader:
     
     def get_downloaded_models(self) -> List[str]:
         """Get list of downloaded model IDs."""
-        downloaded = []
-        for model in AVAILABLE_MODELS:
-            if self.is_downloaded(model.id):
-                downloaded.append(model.id)
-        return downloaded
+        return [model_id for model_id in _MODELS_BY_ID if self.is_downloaded(model_id)]
     
     def get_total_size(self, model_ids: Optional[List[str]] = None) -> float:
         """Get total size of models in GB."""
         if model_ids is None:
-            model_ids = [m.id for m in AVAILABLE_MODELS]
+            model_ids = _MODELS_BY_ID
         
-        total = 0.0
-        for model in AVAILABLE_MODELS:
-            if model.id in model_ids:
-                total += model.size_gb
-        return total
+        # dict.fromkeys drops duplicate IDs while keeping their order
+        sizes = [
+            _MODELS_BY_ID[model_id].size_gb
+            for model_id in dict.fromkeys(model_ids)
+            if model_id in _MODELS_BY_ID
+        ]
+        return sum(sizes, 0.0)
     
-    def cleanup(self, model_id: str) -> bool:
-        """Remove a downloaded model."""
+    def cleanup(self, model_id: str, purge_cache: bool = False) -> bool:
+        """
+        Remove a downloaded model.
+        
+        Args:
+            model_id: ID of the model to remove
+            purge_cache: Also delete the model's files from the HuggingFace cache
+            
+        Returns:
+            True if anything was removed
+        """
         model = self.get_model_info(model_id)
         if not model:
             return False
         
         model_dir = self.models_dir / model.type / model_id
+        removed = False
         
+        # With symlinks this only removes the links; the cache is untouched
         if model_dir.exists():
             import shutil
             shutil.rmtree(model_dir)
             logger.info(f"Removed model: {model_id}")
-            return True
+            removed = True
+        
+        if purge_cache:
+            removed = self._purge_cache(model.repo_id) or removed
+        
+        return removed
+    
+    def _purge_cache(self, repo_id: str) -> bool:
+        """Delete all cached revisions of a repo from the HuggingFace cache."""
+        cache_info = scan_cache_dir()
+        revisions = [
+            revision.commit_hash
+            for repo in cache_info.repos
+            if repo.repo_id == repo_id
+            for revision in repo.revisions
+        ]
+        if not revisions:
+            return False
         
-        return False
+        strategy = cache_info.delete_revisions(*revisions)
+        logger.info(f"Purging {repo_id} from HF cache ({strategy.expected_freed_size_str})")
+        strategy.execute()
+        return True
 
 
 # CLI interface
@@ -10,16 +10,37 @@ License: Apache-2.0
 """
 
 import os
+import json
 import logging
 from pathlib import Path
-from typing import Optional, List, Union
+from typing import Optional, Dict, List, Tuple, Union
+from collections import OrderedDict
 from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import torch
-from huggingface_hub import snapshot_download
-from diffusers import FluxPipeline
+from transformers import CLIPTextConfig, CLIPTextModel, T5Config, T5EncoderModel
+from diffusers import AutoencoderKL, FluxPipeline, FluxTransformer2DModel
 from PIL import Image
 
+from common.pipeline_utils import (
+    ATTENTION_BACKEND,
+    compile_pipeline,
+    cudagraph_step_callback,
+    detect_device,
+    direct_device_map,
+    download_snapshot,
+    optimal_dtype,
+    prepare_pipeline,
+    quantize_fp8,
+    resolve_offload,
+    restore_pipeline_defaults,
+    set_first_block_cache,
+    transformer_components,
+    weights_device,
+)
+
 logger = logging.getLogger(__name__)
 
 # Model configurations
@@ -28,7 +49,32 @@ FLUX_MODELS = {
     "dev": "black-forest-labs/FLUX.1-dev",
 }
 DEFAULT_MODEL = "schnell"
+# Number of prompts whose text-encoder embeddings are kept per wrapper
+PROMPT_CACHE_SIZE = 64
+# Step and guidance bounds per variant: (min steps, max steps, min guidance, max guidance)
+VARIANT_LIMITS = {
+    # Schnell is optimized for 4 steps without guidance
+    "schnell": (0, 4, 0.0, 0.0),
+    # Dev benefits from more steps and guidance
+    "dev": (20, float("inf"), 3.5, float("inf")),
+}
+# Transformer weight precisions: bf16 keeps the native dtype
+PRECISIONS = ("bf16", "fp8", "nf4", "fp8-rowwise", "nvfp4")
+# Precisions applied with torchao after the pipeline is placed on its device
+TORCHAO_PRECISIONS = ("fp8-rowwise", "nvfp4")
+# Minimum CUDA compute capability of precisions with hardware-specific kernels:
+# FP8 tensor cores (Ada, Hopper) and NVFP4 (Blackwell)
+PRECISION_MIN_CAPABILITY = {"fp8-rowwise": (8, 9), "nvfp4": (10, 0)}
+# Only the double- and single-stream blocks are quantized; they hold nearly
+# all weights, while embedders and norm modulation layers are precision sensitive
+QUANTIZED_BLOCKS = ("transformer_blocks.", "single_transformer_blocks.")
 MODELS_DIR = Path(os.environ.get("AMFBOT_MODELS_DIR", "./models/flux"))
+# Approximate bf16 transformer footprint per variant
+TRANSFORMER_VRAM_GB = {"schnell": 23.5, "dev": 23.5}
+# Approximate footprint of the unquantized T5-XXL, CLIP and VAE
+ENCODERS_VRAM_GB = 9.5
+# Transformer weight size relative to bf16 for each precision
+PRECISION_WEIGHT_SCALE = {"bf16": 1.0, "fp8": 0.5, "fp8-rowwise": 0.5, "nf4": 0.28, "nvfp4": 0.28}
 
 
 @dataclass
@@ -44,17 +90,69 @@ class ImageGenerationConfig:
     seed: Optional[int] = None
     output_path: Optional[str] = None
     num_images: int = 1
+    cache_threshold: float = 0.0  # first-block cache, ~0.12 for Flux (0 = off)
+    vae_tile_size: Optional[int] = None  # VAE tile size in pixels (None = model default)
+
+
+def precision_supported(precision: str, capability: Optional[Tuple[int, int]]) -> bool:
+    """
+    Check whether a precision runs on a GPU.
+    
+    Args:
+        precision: Transformer weight precision
+        capability: CUDA compute capability of the GPU, or None without CUDA
+    """
+    required = PRECISION_MIN_CAPABILITY.get(precision)
+    return required is None or (capability is not None and tuple(capability) >= required)
+
+
+def pipeline_vram_gb(variant: str, precision: str) -> float:
+    """Get the approximate VRAM footprint of a whole pipeline held on the GPU."""
+    return TRANSFORMER_VRAM_GB[variant] * PRECISION_WEIGHT_SCALE[precision] + ENCODERS_VRAM_GB
+
+
+def _is_block_linear(module: torch.nn.Module, fqn: str) -> bool:
+    """Check whether a module is a linear layer of a block, excluding norm modulation."""
+    return (
+        isinstance(module, torch.nn.Linear)
+        and fqn.startswith(QUANTIZED_BLOCKS)
+        and ".norm" not in fqn
+    )
+
+
+def _cast_floats(value, dtype: torch.dtype):
+    """Cast floating point tensors, and tuples of them, to dtype."""
+    if isinstance(value, tuple):
+        return tuple(_cast_floats(item, dtype) for item in value)
+    if isinstance(value, torch.Tensor) and value.is_floating_point():
+        return value.to(dtype)
+    return value
+
+
+# Loaded pipelines shared by wrappers with the same load options, so
+# short-lived wrappers don't reload the weights
+_PIPELINE_CACHE: Dict[tuple, FluxPipeline] = {}
 
 
 class FluxWrapper:
     """Wrapper for Flux.1 image generation model."""
     
+    # Shared PNG encoders; Pillow releases the GIL while compressing
+    _io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="flux-io")
+    
     def __init__(
         self,
         model_variant: str = DEFAULT_MODEL,
         device: Optional[str] = None,
         dtype: Optional[torch.dtype] = None,
-        enable_model_cpu_offload: bool = True,
+        cpu_offload: str = "auto",
+        flashpack_path: Optional[Union[str, Path]] = None,
+        precision: str = "bf16",
+        compile_model: bool = False,
+        compile_mode: str = "reduce-overhead",
+        attention_backend: Optional[str] = ATTENTION_BACKEND,
+        npcache_dir: Optional[Union[str, Path]] = None,
+        fast_fp16: bool = False,
     ):
         """
         Initialize Flux wrapper.
@@ -63,73 +161,410 @@ class FluxWrapper:
             model_variant: Model variant (schnell, dev)
             device: Device to run on (cuda, mps, cpu)
             dtype: Model precision
-            enable_model_cpu_offload: Enable CPU offload for low VRAM
+            cpu_offload: CPU offload mode (auto, none, model, sequential)
+            flashpack_path: Optional FlashPack file to stream transformer weights from
+            precision: Transformer weight precision (bf16, fp8, nf4, fp8-rowwise, nvfp4)
+            compile_model: Compile the transformer and VAE decoder with torch.compile
+            compile_mode: torch.compile mode
+            attention_backend: diffusers attention backend (flash, _flash_3, sage, xformers)
+            npcache_dir: Optional numpy weight cache for the text encoders and VAE
+            fast_fp16: Run the transformer blocks' linear layers as FP16 matmuls with
+                FP16 accumulation (pre-Hopper GPUs, requires torch-cublas-hgemm)
         """
         if model_variant not in FLUX_MODELS:
             raise ValueError(f"Unknown model variant: {model_variant}. Choose from: {list(FLUX_MODELS.keys())}")
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}. Choose from: {list(PRECISIONS)}")
         
         self.model_variant = model_variant
         self.model_id = FLUX_MODELS[model_variant]
-        self.device = device or self._detect_device()
-        self.dtype = dtype or self._get_optimal_dtype()
-        self.enable_cpu_offload = enable_model_cpu_offload
+        self._min_steps, self._max_steps, self._min_guidance, self._max_guidance = (
+            VARIANT_LIMITS[model_variant]
+        )
+        self.device = device or detect_device()
+        capability = torch.cuda.get_device_capability() if self.device == "cuda" else None
+        if not precision_supported(precision, capability):
+            major, minor = PRECISION_MIN_CAPABILITY[precision]
+            raise ValueError(
+                f"Precision {precision} requires a CUDA GPU with compute capability "
+                f"{major}.{minor}+"
+            )
+        self.fast_fp16 = fast_fp16 and self._supports_fast_fp16(precision, compile_model)
+        self.dtype = dtype or optimal_dtype(self.device)
+        self.footprint_gb = pipeline_vram_gb(model_variant, precision)
+        self.cpu_offload = resolve_offload(cpu_offload, self.device, self.footprint_gb)
+        self.flashpack_path = Path(flashpack_path) if flashpack_path else None
+        self.precision = precision
+        self.compile_model = compile_model
+        self.compile_mode = compile_mode
+        self.attention_backend = attention_backend
+        self.npcache_dir = Path(npcache_dir) if npcache_dir else None
         
         self._pipeline: Optional[FluxPipeline] = None
+        self.cache_threshold = 0.0
+        # Set when the pipeline is compiled with CUDA graphs
+        self._step_callback = None
+        # The VAE's own tile size, restored when a request sets none
+        self._vae_default_tile: Optional[int] = None
+        # Prompt embeddings on (pinned) CPU memory, least recently used first
+        self._prompt_cache: "OrderedDict[str, Tuple[torch.Tensor, torch.Tensor]]" = OrderedDict()
+        # Initial latents of the last seeded request and their (seed, count, width, height)
+        self._latents: Optional[torch.Tensor] = None
+        self._latents_key: Optional[tuple] = None
+        # Generators reseeded for each seeded batch, one per image
+        self._generators: List[torch.Generator] = []
         
         logger.info(f"Flux initialized: variant={model_variant}, device={self.device}, dtype={self.dtype}")
     
-    def _detect_device(self) -> str:
-        """Detect the best available device."""
-        if torch.cuda.is_available():
-            return "cuda"
-        elif torch.backends.mps.is_available():
-            return "mps"
-        return "cpu"
-    
-    def _get_optimal_dtype(self) -> torch.dtype:
-        """Get optimal dtype for the device."""
-        if self.device == "cuda":
-            if torch.cuda.is_bf16_supported():
-                return torch.bfloat16
-            return torch.float16
-        elif self.device == "mps":
-            return torch.float16
-        return torch.float32
+    def _supports_fast_fp16(self, precision: str, compile_model: bool) -> bool:
+        """
+        Check whether FP16-accumulate linear layers can be used.
+        
+        Consumer GPUs before Hopper run FP16 matmuls with FP16 accumulation
+        at about twice the tensor-core throughput of FP32 accumulation.
+        """
+        if self.device != "cuda" or torch.cuda.get_device_capability()[0] >= 9:
+            logger.info("fast_fp16 disabled: only faster on pre-Hopper CUDA GPUs")
+            return False
+        if precision != "bf16" or compile_model:
+            # Quantized layers and compiled graphs don't use nn.Linear kernels
+            logger.info("fast_fp16 disabled: requires unquantized weights without torch.compile")
+            return False
+        return True
     
     def ensure_model_downloaded(self) -> Path:
         """Ensure model weights are downloaded."""
-        models_dir = MODELS_DIR / self.model_variant
-        
-        if not models_dir.exists():
-            logger.info(f"Downloading model: {self.model_id}")
-            snapshot_download(
-                repo_id=self.model_id,
-                local_dir=models_dir,
-                ignore_patterns=["*.md", "*.txt"],
-            )
-            logger.info("Model download complete")
-        
-        return models_dir
+        return download_snapshot(self.model_id, MODELS_DIR / self.model_variant)
+    
+    def _cache_key(self) -> tuple:
+        """Get the key of this wrapper's pipeline in the shared pipeline cache."""
+        return (
+            self.model_id,
+            self.device,
+            str(self.dtype),
+            self.cpu_offload,
+            self.precision,
+            self.compile_model,
+            self.compile_mode,
+            self.attention_backend,
+            self.fast_fp16,
+        )
     
     def _load_pipeline(self) -> FluxPipeline:
-        """Load the image generation pipeline."""
+        """Load the image generation pipeline, reusing a cached one if possible."""
         if self._pipeline is None:
-            logger.info(f"Loading Flux pipeline ({self.model_variant})...")
-            
-            self._pipeline = FluxPipeline.from_pretrained(
-                self.model_id,
-                torch_dtype=self.dtype,
-            )
+            key = self._cache_key()
+            pipeline = _PIPELINE_CACHE.get(key)
             
-            if self.enable_cpu_offload and self.device == "cuda":
-                self._pipeline.enable_model_cpu_offload()
+            if pipeline is None:
+                logger.info(f"Loading Flux pipeline ({self.model_variant})...")
+                pipeline = self._build_pipeline()
+                _PIPELINE_CACHE[key] = pipeline
+                logger.info("Flux pipeline loaded")
             else:
-                self._pipeline = self._pipeline.to(self.device)
+                logger.info(f"Reusing cached Flux pipeline ({self.model_variant})")
             
-            logger.info("Flux pipeline loaded")
+            self._pipeline = pipeline
+            self._vae_default_tile = pipeline.vae.tile_sample_min_size
+            self._step_callback = cudagraph_step_callback(pipeline, self.compile_mode)
         
         return self._pipeline
     
+    def _build_pipeline(self) -> FluxPipeline:
+        """Load, quantize, place and compile a new pipeline."""
+        device_map = direct_device_map(self.device, self.cpu_offload)
+        pipeline = FluxPipeline.from_pretrained(
+            self.model_id,
+            torch_dtype=self.dtype,
+            low_cpu_mem_usage=True,
+            device_map=device_map,
+            **self._preloaded_components(),
+        )
+        
+        if self.precision == "fp8":
+            quantize_fp8(pipeline.transformer)
+        
+        if self.fast_fp16:
+            self._use_cublas_linear(pipeline.transformer)
+        
+        pipeline = prepare_pipeline(
+            pipeline,
+            self.device,
+            self.cpu_offload,
+            placed=device_map is not None,
+            vae_memory_format=torch.channels_last,
+            attention_backend=self.attention_backend,
+        )
+        
+        if self.precision in TORCHAO_PRECISIONS:
+            self._quantize_torchao(pipeline.transformer)
+        
+        if self.compile_model:
+            compile_pipeline(
+                pipeline,
+                self.device,
+                self.cpu_offload,
+                self.compile_mode,
+                MODELS_DIR / ".compile_cache",
+            )
+        
+        return pipeline
+    
+    def _preloaded_components(self) -> dict:
+        """Get components loaded outside from_pretrained, if any."""
+        components = {}
+        
+        if self.npcache_dir is not None:
+            builders = {
+                "text_encoder": lambda: CLIPTextModel(
+                    CLIPTextConfig.from_pretrained(self.model_id, subfolder="text_encoder")
+                ),
+                "text_encoder_2": lambda: T5EncoderModel(
+                    T5Config.from_pretrained(self.model_id, subfolder="text_encoder_2")
+                ),
+                "vae": lambda: AutoencoderKL.from_config(
+                    AutoencoderKL.load_config(self.model_id, subfolder="vae")
+                ),
+            }
+            for component, build_model in builders.items():
+                model = self._load_npcache_component(component, build_model)
+                # Components without a complete cache load through from_pretrained
+                if model is not None:
+                    components[component] = model
+        
+        components.update(transformer_components(
+            FluxTransformer2DModel,
+            self.model_id,
+            self.precision,
+            self.flashpack_path,
+            self.device,
+            self.dtype,
+            self.cpu_offload,
+        ))
+        return components
+    
+    def _load_npcache_component(self, component: str, build_model):
+        """
+        Build a component skeleton and assign its weights from the npcache.
+        
+        Args:
+            component: Pipeline component name (text_encoder, text_encoder_2, vae)
+            build_model: Callable creating the model from its config
+            
+        Returns:
+            The loaded model, or None if the cache doesn't cover all of its weights
+        """
+        from accelerate import init_empty_weights
+        
+        cache_dir = self.npcache_dir / component
+        index_path = cache_dir / "index.json"
+        if not index_path.exists():
+            logger.warning(f"No npcache for {component}, loading it from the model files")
+            return None
+        index = json.loads(index_path.read_text())
+        
+        device = weights_device(self.device, self.cpu_offload)
+        
+        state_dict = {}
+        for key, entry in index.items():
+            # Copy-on-write maps keep tensors writable without reading the file
+            tensor = torch.from_numpy(np.load(cache_dir / entry["file"], mmap_mode="c"))
+            if entry["dtype"] == "bfloat16":
+                tensor = tensor.view(torch.bfloat16)
+            state_dict[key] = tensor.to(device, dtype=self.dtype, non_blocking=True)
+        
+        with init_empty_weights():
+            model = build_model()
+        # Not strict, since tied weights are stored once and tied below
+        model.load_state_dict(state_dict, strict=False, assign=True)
+        if hasattr(model, "tie_weights"):
+            model.tie_weights()
+        
+        # Weights missing from the cache would stay on the meta device
+        missing = [name for name, param in model.named_parameters() if param.is_meta]
+        if missing:
+            logger.warning(
+                f"npcache for {component} is missing {len(missing)} weights "
+                f"(e.g. {missing[0]}), loading it from the model files"
+            )
+            return None
+        
+        logger.info(f"Loaded {component} from npcache")
+        # Non-persistent buffers (e.g. CLIP position_ids) aren't in the cache
+        # and were built on CPU, so move them next to the weights
+        return model.to(device).eval()
+    
+    def _quantize_torchao(self, transformer: FluxTransformer2DModel) -> None:
+        """
+        Quantize the transformer blocks' linear layers with torchao in place.
+        
+        fp8-rowwise uses dynamic FP8 activations and weights with per-row
+        scales (Hopper and newer). nvfp4 uses 4-bit NVFP4 weights (Blackwell).
+        """
+        from torchao.quantization import (
+            Float8DynamicActivationFloat8WeightConfig,
+            PerRow,
+            quantize_,
+        )
+        
+        if self.precision == "nvfp4":
+            from torchao.prototype.mx_formats import NVFP4InferenceConfig
+            config = NVFP4InferenceConfig()
+        else:
+            config = Float8DynamicActivationFloat8WeightConfig(granularity=PerRow())
+        
+        logger.info(f"Quantizing transformer blocks to {self.precision}...")
+        quantize_(transformer, config, filter_fn=_is_block_linear)
+    
+    def _use_cublas_linear(self, transformer: FluxTransformer2DModel) -> None:
+        """
+        Swap the transformer blocks' linear layers for FP16-accumulate cuBLAS ones in place.
+        
+        Only the transformer is cast to FP16; the text encoders and VAE keep
+        the pipeline dtype, since T5-XXL activations overflow in FP16. Inputs
+        are cast to FP16 on the way in and outputs back on the way out. Norm
+        modulation layers keep FP32 accumulation, since their outputs scale
+        every activation of the block.
+        """
+        try:
+            from cublas_ops import CublasLinear
+        except ImportError:
+            logger.warning("torch-cublas-hgemm not installed, keeping the default linear layers")
+            return
+        
+        dtype = transformer.dtype
+        transformer.to(torch.float16)
+        transformer.register_forward_pre_hook(
+            lambda module, args, kwargs: (
+                _cast_floats(args, torch.float16),
+                {name: _cast_floats(value, torch.float16) for name, value in kwargs.items()},
+            ),
+            with_kwargs=True,
+        )
+        transformer.register_forward_hook(
+            lambda module, args, output: _cast_floats(output, dtype)
+        )
+        
+        swapped = 0
+        for fqn, module in list(transformer.named_modules()):
+            if not _is_block_linear(module, fqn):
+                continue
+            
+            with torch.device("meta"):
+                fast = CublasLinear(
+                    module.in_features, module.out_features, bias=module.bias is not None
+                )
+            # Share the loaded parameters instead of copying them
+            fast.weight = module.weight
+            fast.bias = module.bias
+            
+            parent_name, _, name = fqn.rpartition(".")
+            setattr(transformer.get_submodule(parent_name), name, fast)
+            swapped += 1
+        
+        logger.info(f"Using FP16-accumulate cuBLAS kernels for {swapped} linear layers")
+    
+    def warmup(self, width: Optional[int] = None, height: Optional[int] = None) -> None:
+        """
+        Load the pipeline and run a one-step generation to prime CUDA kernels.
+        
+        Compiled graphs are specialized on shape, so compiled pipelines warm
+        up at the default output size unless another size is given.
+        
+        Args:
+            width: Warmup image width
+            height: Warmup image height
+        """
+        pipeline = self._load_pipeline()
+        
+        default_size = 1024 if self.compile_model else 256
+        width = width or default_size
+        height = height or default_size
+        
+        logger.info(f"Warming up Flux pipeline ({self.model_variant}, {width}x{height})...")
+        with torch.inference_mode():
+            pipeline(
+                prompt="warmup",
+                width=width,
+                height=height,
+                num_inference_steps=1,
+                guidance_scale=0.0,
+                callback_on_step_end=self._step_callback,
+            )
+        logger.info("Flux pipeline warm")
+    
+    def _set_cache_threshold(self, pipeline: FluxPipeline, threshold: float) -> None:
+        """Enable, retune or disable the first-block cache on the transformer."""
+        self.cache_threshold = set_first_block_cache(
+            pipeline.transformer, self.cache_threshold, threshold
+        )
+    
+    def _set_vae_tile_size(self, pipeline: FluxPipeline, tile_size: Optional[int]) -> None:
+        """Set the VAE decode tile size in pixels, or restore the default for None."""
+        tile_size = tile_size or self._vae_default_tile
+        pipeline.vae.tile_sample_min_size = tile_size
+        pipeline.vae.tile_latent_min_size = tile_size // pipeline.vae_scale_factor
+    
+    def _encode_prompt(
+        self, pipeline: FluxPipeline, prompt: str
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Get the T5 and CLIP embeddings of a prompt, encoding it only on a cache miss.
+        
+        Cached embeddings live in pinned CPU memory so they don't hold VRAM,
+        and are copied to the execution device on use.
+        """
+        device = pipeline._execution_device
+        
+        cached = self._prompt_cache.get(prompt)
+        if cached is not None:
+            self._prompt_cache.move_to_end(prompt)
+        else:
+            with torch.no_grad():
+                prompt_embeds, pooled_prompt_embeds, _ = pipeline.encode_prompt(
+                    prompt=prompt, prompt_2=None, device=device
+                )
+            cached = (prompt_embeds.cpu(), pooled_prompt_embeds.cpu())
+            if torch.cuda.is_available():
+                cached = tuple(tensor.pin_memory() for tensor in cached)
+            
+            self._prompt_cache[prompt] = cached
+            if len(self._prompt_cache) > PROMPT_CACHE_SIZE:
+                self._prompt_cache.popitem(last=False)
+        
+        return tuple(tensor.to(device, non_blocking=True) for tensor in cached)
+    
+    def _seeded_latents(
+        self, pipeline: FluxPipeline, seed: int, num_images: int, width: int, height: int
+    ) -> torch.Tensor:
+        """
+        Get the initial latents of a seeded batch, reusing the last ones if they match.
+        
+        Image i is drawn from its own generator seeded with seed + i, so it
+        matches a single-image run with that seed. The pipeline doesn't
+        modify the latents it is given, so they can be passed again.
+        """
+        key = (seed, num_images, width, height)
+        if key != self._latents_key:
+            while len(self._generators) < num_images:
+                self._generators.append(torch.Generator(device=self.device))
+            generators = [
+                generator.manual_seed(seed + i)
+                for i, generator in enumerate(self._generators[:num_images])
+            ]
+            self._latents, _ = pipeline.prepare_latents(
+                num_images,
+                pipeline.transformer.config.in_channels // 4,
+                height,
+                width,
+                self.dtype,
+                pipeline._execution_device,
+                generators,
+            )
+            self._latents_key = key
+        
+        return self._latents
+    
     def generate_image(self, config: ImageGenerationConfig) -> Union[str, List[str]]:
         """
         Generate image(s) from text prompt.
@@ -141,40 +576,42 @@ class FluxWrapper:
             Path to generated image file(s)
         """
         pipeline = self._load_pipeline()
+        self._set_cache_threshold(pipeline, config.cache_threshold)
+        self._set_vae_tile_size(pipeline, config.vae_tile_size)
         
-        # Set seed for reproducibility
-        generator = None
+        # Seeded requests start from precomputed latents for reproducibility
+        latents = None
         if config.seed is not None:
-            generator = torch.Generator(device=self.device).manual_seed(config.seed)
-        
-        logger.info(f"Generating image: {config.prompt[:50]}...")
+            latents = self._seeded_latents(
+                pipeline, config.seed, config.num_images, config.width, config.height
+            )
         
-        # Adjust parameters based on model variant
-        num_steps = config.num_inference_steps
-        guidance = config.guidance_scale
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"Generating image: {config.prompt[:50]}...")
         
-        if self.model_variant == "schnell":
-            # Schnell is optimized for 4 steps without guidance
-            num_steps = min(num_steps, 4)
-            guidance = 0.0
-        elif self.model_variant == "dev":
-            # Dev model benefits from more steps and guidance
-            num_steps = max(num_steps, 20)
-            guidance = max(guidance, 3.5)
+        # Clamp parameters to the variant's bounds
+        num_steps = min(max(config.num_inference_steps, self._min_steps), self._max_steps)
+        guidance = min(max(config.guidance_scale, self._min_guidance), self._max_guidance)
         
         # Generate images
+        # Embeddings are repeated for the batch, so the pipeline sees a batch
+        # of prompts with one image each
+        prompt_embeds, pooled_prompt_embeds = self._encode_prompt(pipeline, config.prompt)
         output = pipeline(
-            prompt=config.prompt,
+            prompt_embeds=prompt_embeds.repeat(config.num_images, 1, 1),
+            pooled_prompt_embeds=pooled_prompt_embeds.repeat(config.num_images, 1),
             width=config.width,
             height=config.height,
             num_inference_steps=num_steps,
             guidance_scale=guidance,
-            generator=generator,
-            num_images_per_prompt=config.num_images,
+            latents=latents,
+            callback_on_step_end=self._step_callback,
+            num_images_per_prompt=1,
         )
         
-        # Save images
+        # Encode and save images in parallel
         output_paths = []
+        saves = []
         for i, image in enumerate(output.images):
             if config.num_images == 1:
                 path = config.output_path or f"output_{config.seed or 'random'}.png"
@@ -183,8 +620,12 @@ class FluxWrapper:
                 name, ext = os.path.splitext(base)
                 path = f"{name}_{i}{ext or '.png'}"
             
-            image.save(path)
+            # Fast zlib level: files are slightly larger but encode several times faster
+            saves.append(self._io_pool.submit(image.save, path, compress_level=1))
             output_paths.append(path)
+        
+        for path, save in zip(output_paths, saves):
+            save.result()
             logger.info(f"Image saved to: {path}")
         
         return output_paths[0] if config.num_images == 1 else output_paths
@@ -197,7 +638,7 @@ class FluxWrapper:
         **kwargs,
     ) -> List[str]:
         """
-        Generate multiple variations of an image.
+        Generate multiple variations of an image in one batched pipeline call.
         
         Args:
             prompt: Text description
@@ -208,28 +649,43 @@ class FluxWrapper:
         Returns:
             List of paths to generated images
         """
-        output_paths = []
-        
-        for i in range(num_variations):
-            config = ImageGenerationConfig(
-                prompt=prompt,
-                seed=base_seed + i,
-                output_path=f"variation_{i}.png",
-                **kwargs,
-            )
-            path = self.generate_image(config)
-            output_paths.append(path)
+        # Image i uses seed base_seed + i and is saved as variation_{i}.png.
+        # Batches get the index appended to the path, single images don't.
+        config = ImageGenerationConfig(
+            prompt=prompt,
+            seed=base_seed,
+            output_path="variation.png" if num_variations > 1 else "variation_0.png",
+            num_images=num_variations,
+            **kwargs,
+        )
+        result = self.generate_image(config)
         
-        return output_paths
+        return [result] if isinstance(result, str) else result
     
-    def unload(self) -> None:
-        """Unload pipeline to free memory."""
-        self._pipeline = None
+    def unload(self, purge: bool = False) -> None:
+        """
+        Release the pipeline.
         
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
+        Args:
+            purge: Also drop it from the shared pipeline cache to free memory.
+                Otherwise it stays loaded for the next wrapper with the same options.
+        """
+        if purge:
+            _PIPELINE_CACHE.pop(self._cache_key(), None)
+        elif self._pipeline is not None:
+            restore_pipeline_defaults(self._pipeline, self.cache_threshold, self._set_vae_tile_size)
+        
+        self._pipeline = None
+        self.cache_threshold = 0.0
+        self._step_callback = None
+        self._latents = None
+        self._latents_key = None
         
-        logger.info("Pipeline unloaded")
+        if purge:
+            self._prompt_cache.clear()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            logger.info("Pipeline unloaded")
     
     def get_model_info(self) -> dict:
         """Get information about the loaded model."""
@@ -237,8 +693,14 @@ class FluxWrapper:
             "model_variant": self.model_variant,
             "model_id": self.model_id,
             "device": self.device,
+            "cpu_offload": self.cpu_offload,
             "dtype": str(self.dtype),
+            "precision": self.precision,
+            "compiled": self.compile_model,
+            "compile_mode": self.compile_mode,
+            "fast_fp16": self.fast_fp16,
             "pipeline_loaded": self._pipeline is not None,
+            "cache_threshold": self.cache_threshold,
         }
 
 
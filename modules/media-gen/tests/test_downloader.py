@@ -0,0 +1,228 @@
+"""
+Unit tests — ModelDownloader file transfers
+
+Covers:
+  - Resuming a partial .incomplete file with a Range request
+  - Starting over after HTTP 416 and when the server ignores Range
+  - Retrying downloads whose content doesn't match the repo's hash
+  - Fetching blobs shared by several repo files once
+"""
+
+import sys
+import hashlib
+import functools
+from pathlib import Path
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import downloader
+from downloader import DownloadProgress, ModelDownloader
+
+CONTENT = bytes(range(256)) * 64
+REPO_ID = "org/model"
+REVISION = "0123abcd"
+
+
+# ── Helpers ───────────────────────────────────────────────────────────────────
+
+def lfs_file(name: str, content: bytes = CONTENT) -> SimpleNamespace:
+    """Repo file metadata of an LFS file."""
+    return SimpleNamespace(
+        rfilename=name,
+        size=len(content),
+        lfs=SimpleNamespace(sha256=hashlib.sha256(content).hexdigest()),
+        blob_id=None,
+    )
+
+
+def git_file(name: str, content: bytes = CONTENT) -> SimpleNamespace:
+    """Repo file metadata of a regular git file, identified by its blob ID."""
+    header = f"blob {len(content)}\0".encode()
+    return SimpleNamespace(
+        rfilename=name,
+        size=len(content),
+        lfs=None,
+        blob_id=hashlib.sha1(header + content).hexdigest(),
+    )
+
+
+def new_progress() -> DownloadProgress:
+    return DownloadProgress(
+        model_id="model",
+        total_bytes=len(CONTENT),
+        downloaded_bytes=0,
+        current_file="",
+        files_completed=0,
+        files_total=1,
+    )
+
+
+def serve(content: bytes = CONTENT, honor_range: bool = True):
+    """Build a handler serving content, recording the Range header of each request."""
+    requests = []
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        range_header = request.headers.get("Range")
+        requests.append(range_header)
+        if range_header and honor_range:
+            start = int(range_header.removeprefix("bytes=").rstrip("-"))
+            if start >= len(content):
+                return httpx.Response(416)
+            return httpx.Response(206, content=content[start:])
+        return httpx.Response(200, content=content)
+    
+    handler.requests = requests
+    return handler
+
+
+async def fetch(tmp_path: Path, handler, file) -> tuple:
+    """Download one file through a mock transport."""
+    dest = tmp_path / "out" / file.rfilename
+    progress = new_progress()
+    async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+        await ModelDownloader(models_dir=tmp_path)._download_file(
+            client, REPO_ID, REVISION, file, dest, progress, lambda: None
+        )
+    return dest, progress
+
+
+# ── Fixtures ──────────────────────────────────────────────────────────────────
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    async def sleep(delay):
+        pass
+    
+    monkeypatch.setattr(downloader.asyncio, "sleep", sleep)
+
+
+# ── Resume ────────────────────────────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_resumes_partial_download(tmp_path: Path):
+    dest = tmp_path / "out" / "model.safetensors"
+    dest.parent.mkdir(parents=True)
+    dest.with_name("model.safetensors.incomplete").write_bytes(CONTENT[:1000])
+    handler = serve()
+    
+    dest, progress = await fetch(tmp_path, handler, lfs_file("model.safetensors"))
+    
+    assert handler.requests == ["bytes=1000-"]
+    assert dest.read_bytes() == CONTENT
+    assert not dest.with_name("model.safetensors.incomplete").exists()
+    assert progress.downloaded_bytes == len(CONTENT)
+    assert progress.files_completed == 1
+
+
+@pytest.mark.asyncio
+async def test_416_starts_over(tmp_path: Path):
+    # The server rejects the resume range, e.g. after the remote file changed
+    short = CONTENT[:2000]
+    dest = tmp_path / "out" / "model.safetensors"
+    dest.parent.mkdir(parents=True)
+    dest.with_name("model.safetensors.incomplete").write_bytes(CONTENT[:2000 - 1])
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        handler.requests.append(request.headers.get("Range"))
+        if request.headers.get("Range"):
+            return httpx.Response(416)
+        return httpx.Response(200, content=short)
+    
+    handler.requests = []
+    
+    dest, progress = await fetch(tmp_path, handler, lfs_file("model.safetensors", short))
+    
+    assert handler.requests == ["bytes=1999-", None]
+    assert dest.read_bytes() == short
+    assert progress.downloaded_bytes == len(short)
+
+
+@pytest.mark.asyncio
+async def test_ignored_range_starts_over(tmp_path: Path):
+    dest = tmp_path / "out" / "config.json"
+    dest.parent.mkdir(parents=True)
+    dest.with_name("config.json.incomplete").write_bytes(CONTENT[:1000])
+    handler = serve(honor_range=False)
+    
+    dest, progress = await fetch(tmp_path, handler, git_file("config.json"))
+    
+    assert handler.requests == ["bytes=1000-"]
+    assert dest.read_bytes() == CONTENT
+    assert progress.downloaded_bytes == len(CONTENT)
+
+
+# ── Verification ──────────────────────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_hash_mismatch_is_retried(tmp_path: Path):
+    corrupt = bytes(len(CONTENT))
+    responses = [corrupt, CONTENT]
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=responses.pop(0))
+    
+    dest, progress = await fetch(tmp_path, handler, lfs_file("model.safetensors"))
+    
+    assert responses == []
+    assert dest.read_bytes() == CONTENT
+    assert progress.downloaded_bytes == len(CONTENT)
+
+
+@pytest.mark.asyncio
+async def test_hash_mismatch_fails_after_retries(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(downloader, "DOWNLOAD_RETRIES", 2)
+    handler = serve(content=bytes(len(CONTENT)))
+    
+    with pytest.raises(OSError, match="hash"):
+        await fetch(tmp_path, handler, lfs_file("model.safetensors"))
+    
+    assert len(handler.requests) == 2
+    assert not (tmp_path / "out" / "model.safetensors").exists()
+
+
+# ── Duplicate blobs ───────────────────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_duplicate_blobs_are_fetched_once(tmp_path: Path, monkeypatch):
+    files = [
+        lfs_file("text_encoder/model.safetensors"),
+        lfs_file("text_encoder_2/model.safetensors"),
+        git_file("config.json", b"{}"),
+    ]
+    info = SimpleNamespace(sha=REVISION, siblings=files)
+    api = SimpleNamespace(model_info=lambda *args, **kwargs: info)
+    monkeypatch.setattr(downloader, "HfApi", lambda: api)
+    monkeypatch.setattr(downloader, "HF_HUB_CACHE", str(tmp_path / "hub"))
+    monkeypatch.setattr(downloader, "USE_SYMLINKS", True)
+    monkeypatch.setattr(downloader, "USE_NPCACHE", False)
+    monkeypatch.setattr(downloader, "HAS_FLASHPACK", False)
+    
+    urls = []
+    
+    def handler(request: httpx.Request) -> httpx.Response:
+        urls.append(request.url.path)
+        is_config = request.url.path.endswith(".json")
+        return httpx.Response(200, content=b"{}" if is_config else CONTENT)
+    
+    client = functools.partial(httpx.AsyncClient, transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(downloader.httpx, "AsyncClient", client)
+    
+    models = ModelDownloader(models_dir=tmp_path / "models")
+    model = models.get_model_info("flux-schnell")
+    model_dir = tmp_path / "models" / "image" / "flux-schnell"
+    progress = new_progress()
+    
+    await models._download(model, model_dir, progress, None)
+    
+    assert len(urls) == 2
+    assert progress.files_total == 2
+    assert progress.files_completed == 2
+    assert progress.total_bytes == len(CONTENT) + 2
+    assert progress.percentage == 100.0
+    for file in files[:2]:
+        assert (model_dir / file.rfilename).read_bytes() == CONTENT
+    assert (model_dir / downloader.MARKER_FILENAME).exists()
@@ -0,0 +1,136 @@
+"""
+Unit tests — JobStore
+
+Covers:
+  - Creating, updating and reading job records
+  - Caching of finished jobs only
+  - Failing interrupted jobs of previous server runs on open
+  - Purging expired jobs together with their output files
+"""
+
+import sys
+import time
+from pathlib import Path
+
+import pytest
+import pytest_asyncio
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from api import job_store
+from api.job_store import JobStore
+
+
+# ── Fixtures ──────────────────────────────────────────────────────────────────
+
+@pytest.fixture
+def db_path(tmp_path: Path) -> Path:
+    return tmp_path / "jobs.sqlite"
+
+
+@pytest_asyncio.fixture
+async def store(db_path: Path):
+    store = JobStore(db_path, ttl=60, owner="run-a")
+    await store.open()
+    yield store
+    await store.close()
+
+
+# ── Create / update ───────────────────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_get_unknown_job(store: JobStore):
+    assert await store.get("missing") is None
+
+
+@pytest.mark.asyncio
+async def test_create_and_update(store: JobStore):
+    await store.set("job", {"status": "pending"})
+    assert await store.get("job") == {"status": "pending"}
+    
+    await store.set("job", {"status": "completed", "result": "out.png"})
+    assert await store.get("job") == {"status": "completed", "result": "out.png"}
+
+
+@pytest.mark.asyncio
+async def test_failed_job_keeps_error(store: JobStore):
+    await store.set("job", {"status": "failed", "error": "boom"})
+    assert await store.get("job") == {"status": "failed", "error": "boom"}
+
+
+@pytest.mark.asyncio
+async def test_only_finished_jobs_are_cached(store: JobStore):
+    await store.set("job", {"status": "processing"})
+    await store.get("job")
+    assert "job" not in store._cache
+    
+    await store.set("job", {"status": "completed", "result": "out.png"})
+    assert store._cache["job"] == {"status": "completed", "result": "out.png"}
+
+
+@pytest.mark.asyncio
+async def test_records_survive_reopen(db_path: Path, store: JobStore):
+    await store.set("job", {"status": "completed", "result": "out.png"})
+    
+    reopened = JobStore(db_path, owner="run-a")
+    await reopened.open()
+    assert await reopened.get("job") == {"status": "completed", "result": "out.png"}
+    await reopened.close()
+
+
+# ── Interrupted jobs ──────────────────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_open_fails_jobs_of_previous_runs(db_path: Path, store: JobStore):
+    await store.set("running", {"status": "processing"})
+    await store.set("done", {"status": "completed", "result": "out.png"})
+    
+    restarted = JobStore(db_path, owner="run-b")
+    await restarted.open()
+    assert await restarted.get("running") == {
+        "status": "failed",
+        "error": "Interrupted by server restart",
+    }
+    assert await restarted.get("done") == {"status": "completed", "result": "out.png"}
+    await restarted.close()
+
+
+@pytest.mark.asyncio
+async def test_open_keeps_jobs_of_sibling_workers(db_path: Path, store: JobStore):
+    await store.set("running", {"status": "processing"})
+    
+    sibling = JobStore(db_path, owner="run-a")
+    await sibling.open()
+    assert await sibling.get("running") == {"status": "processing"}
+    await sibling.close()
+
+
+# ── TTL / purge ───────────────────────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_purge_keeps_recent_jobs(store: JobStore):
+    await store.set("job", {"status": "completed", "result": "out.png"})
+    assert await store.purge_expired() == 0
+    assert await store.get("job") is not None
+
+
+@pytest.mark.asyncio
+async def test_purge_expired_jobs_and_outputs(tmp_path: Path, store: JobStore, monkeypatch):
+    outputs = [tmp_path / f"job_{i}.png" for i in range(3)]
+    for path in outputs:
+        path.write_bytes(b"png")
+    other = tmp_path / "other_0.png"
+    other.write_bytes(b"png")
+    
+    await store.set("job", {"status": "completed", "result": str(outputs[0])})
+    await store.set("running", {"status": "processing"})
+    
+    now = time.time()
+    monkeypatch.setattr(job_store.time, "time", lambda: now + store.ttl + 1)
+    
+    assert await store.purge_expired() == 1
+    assert await store.get("job") is None
+    assert not any(path.exists() for path in outputs)
+    assert other.exists()
+    # Unfinished jobs never expire
+    assert await store.get("running") == {"status": "processing"}
@@ -11,22 +11,73 @@ License: Apache-2.0
 """
 
 import os
+import queue
+import hashlib
 import logging
+import threading
 from pathlib import Path
-from typing import Optional, List, Union
+from typing import Optional, Dict, Union
 from dataclasses import dataclass, field
 
+import numpy as np
 import torch
-from huggingface_hub import hf_hub_download, snapshot_download
-from diffusers import LTXPipeline, LTXImageToVideoPipeline
+from huggingface_hub import hf_hub_download
+from diffusers import (
+    DiffusionPipeline,
+    LTXImageToVideoPipeline,
+    LTXPipeline,
+    LTXVideoTransformer3DModel,
+)
 from PIL import Image
 
+# Optional torchvision encoder: writes a whole clip in one native call.
+# It encodes through PyAV, which torchvision doesn't install itself.
+try:
+    import av  # noqa: F401
+    from torchvision.io import write_video
+    HAS_TORCHVISION_IO = True
+except ImportError:
+    HAS_TORCHVISION_IO = False
+
+from common.pipeline_utils import (
+    ATTENTION_BACKEND,
+    OFFLOAD_MODES,
+    compile_pipeline,
+    cudagraph_step_callback,
+    detect_device,
+    direct_device_map,
+    download_snapshot,
+    optimal_dtype,
+    prepare_pipeline,
+    quantize_fp8,
+    resolve_offload,
+    restore_pipeline_defaults,
+    set_first_block_cache,
+    transformer_components,
+)
+
 logger = logging.getLogger(__name__)
 
 # Default model configurations
 DEFAULT_MODEL = "Lightricks/LTX-Video"
 DISTILLED_MODEL = "Lightricks/LTX-Video-0.9.8-distilled"
 MODELS_DIR = Path(os.environ.get("AMFBOT_MODELS_DIR", "./models/ltx-video"))
+# Approximate bf16 pipeline footprint per model (transformer, T5-XXL and VAE)
+PIPELINE_VRAM_GB = {DISTILLED_MODEL: 18.5, DEFAULT_MODEL: 35.5}
+DEFAULT_VRAM_GB = 35.5
+# Transformer weight precisions: bf16 keeps the native dtype
+PRECISIONS = ("bf16", "fp8", "nf4", "int8")
+# Frames buffered between the generation thread and the video encoder
+VIDEO_WRITE_QUEUE = 64
+# Directory of AOTInductor transformer packages (unset disables AOT compilation)
+AOT_CACHE_DIR = os.environ.get("AMFBOT_LTX_AOT_DIR") or None
+# Comma-separated output sizes (WIDTHxHEIGHTxFRAMES) to AOT-compile; other
+# sizes run eager, so arbitrary requests never stall on a synchronous compile
+AOT_SHAPES = os.environ.get("AMFBOT_LTX_AOT_SHAPES", "768x512x97")
+# Compiled packages kept in the AOT directory, least recently used evicted first
+AOT_MAX_PACKAGES = int(os.environ.get("AMFBOT_LTX_AOT_MAX", 8))
+# Shard the pipeline's components across all visible GPUs instead of offloading
+MULTI_GPU = os.environ.get("AMFBOT_LTX_MULTI_GPU") == "1"
 
 
 @dataclass
@@ -43,7 +94,9 @@ class VideoGenerationConfig:
     seed: Optional[int] = None
     fps: int = 24
     output_path: Optional[str] = None
-    
+    cache_threshold: float = 0.0  # first-block cache, ~0.05 for LTX (0 = off)
+    vae_tile_size: Optional[int] = None  # VAE tile size in pixels (None = model default)
+
 
 @dataclass
 class Image2VideoConfig(VideoGenerationConfig):
@@ -53,6 +106,240 @@ class Image2VideoConfig(VideoGenerationConfig):
     conditioning_strength: float = 1.0
 
 
+# Loaded pipelines shared by wrappers with the same load options, so
+# short-lived wrappers don't reload the weights. Holds a single option set:
+# loading pipelines with other options evicts the previous ones.
+_PIPELINE_CACHE: Dict[tuple, DiffusionPipeline] = {}
+
+
+class BufferedVideoWriter:
+    """
+    Video file writer that encodes and writes frames on a dedicated thread.
+    
+    Frames are queued and consumed by the writer thread, so the producer only
+    waits on encoder or disk latency when the queue is full.
+    """
+    
+    def __init__(
+        self,
+        output_path: str,
+        fps: int,
+        codec: str = "libx264",
+        max_queued: int = VIDEO_WRITE_QUEUE,
+        put_timeout: float = 1.0,
+    ):
+        """
+        Open the output file and start the writer thread.
+        
+        Args:
+            output_path: Path of the video file
+            fps: Frames per second
+            codec: FFmpeg video codec
+            max_queued: Maximum number of frames waiting to be written
+            put_timeout: Seconds to wait on a full queue before logging back-pressure
+        """
+        import imageio
+        
+        self._writer = imageio.get_writer(output_path, fps=fps, codec=codec)
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._put_timeout = put_timeout
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, name="video-writer", daemon=True)
+        self._thread.start()
+    
+    def _run(self) -> None:
+        """Write queued frames until the end-of-stream sentinel."""
+        try:
+            while (frame := self._queue.get()) is not None:
+                self._writer.append_data(frame)
+        except Exception as e:
+            self._error = e
+            # Keep draining so producers never block on a failed writer
+            while self._queue.get() is not None:
+                pass
+        finally:
+            self._writer.close()
+    
+    def write_frame(self, frame: np.ndarray) -> None:
+        """
+        Queue a frame for writing.
+        
+        Args:
+            frame: HxWxC uint8 frame
+        """
+        if self._error is not None:
+            raise self._error
+        
+        try:
+            self._queue.put(frame, timeout=self._put_timeout)
+        except queue.Full:
+            logger.warning("Video writer is falling behind, waiting for queue space")
+            self._queue.put(frame)
+    
+    def close(self) -> None:
+        """Flush the remaining frames and wait for the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+    
+    def __enter__(self) -> "BufferedVideoWriter":
+        return self
+    
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class AOTTransformerForward:
+    """
+    Transformer forward that runs AOTInductor-compiled packages per input shape.
+    
+    AOTInductor packages are specialized to the shapes they were exported
+    with, so each new combination of input shapes is exported and compiled
+    once on first use and saved under the cache directory. Later processes
+    load the saved package instead of compiling again. Packages are built
+    without weights and bound to the transformer's own parameters, so they
+    add no VRAM over the eager module.
+    
+    Only latent sizes in the allow-list are compiled; others run eager. The
+    directory keeps at most max_packages packages, evicting the least
+    recently used.
+    """
+    
+    def __init__(
+        self,
+        transformer,
+        cache_dir: Path,
+        tag: str,
+        shapes: str,
+        spatial_ratio: int,
+        temporal_ratio: int,
+        max_packages: int = AOT_MAX_PACKAGES,
+    ):
+        """
+        Replace the transformer's forward.
+        
+        Args:
+            transformer: Transformer to compile
+            cache_dir: Directory of the compiled packages
+            tag: Package name prefix identifying the model and load options
+            shapes: Comma-separated WIDTHxHEIGHTxFRAMES output sizes to compile
+            spatial_ratio: VAE spatial compression ratio
+            temporal_ratio: VAE temporal compression ratio
+            max_packages: Packages kept in the cache directory
+        """
+        self.transformer = transformer
+        self.cache_dir = cache_dir
+        self.tag = tag
+        self.latent_shapes = self._parse_shapes(shapes, spatial_ratio, temporal_ratio)
+        self.max_packages = max_packages
+        self._eager = transformer.forward
+        # Loaded packages keyed on input shapes, or the eager forward if compiling failed
+        self._runners: dict = {}
+        transformer.forward = self
+    
+    def __call__(self, *args, **kwargs):
+        # Positional calls and first-block cache hooks can't match an exported graph
+        if args or self.transformer.is_cache_enabled:
+            return self._eager(*args, **kwargs)
+        
+        latent_shape = tuple(kwargs.get(name) for name in ("num_frames", "height", "width"))
+        if latent_shape not in self.latent_shapes:
+            return self._eager(**kwargs)
+        
+        key = self._shape_key(kwargs)
+        runner = self._runners.get(key)
+        if runner is None:
+            runner = self._runners[key] = self._load_runner(key, kwargs)
+        return runner(**kwargs)
+    
+    @staticmethod
+    def _parse_shapes(shapes: str, spatial_ratio: int, temporal_ratio: int) -> set:
+        """Get the (num_frames, height, width) latent sizes of the allowed output sizes."""
+        latent_shapes = set()
+        for shape in shapes.split(","):
+            if not shape.strip():
+                continue
+            try:
+                width, height, frames = (int(n) for n in shape.strip().split("x"))
+            except ValueError:
+                logger.warning(f"Ignoring AOT shape {shape!r}: expected WIDTHxHEIGHTxFRAMES")
+                continue
+            # The transformer sees latent sizes
+            latent_frames = (frames - 1) // temporal_ratio + 1
+            latent_shapes.add((latent_frames, height // spatial_ratio, width // spatial_ratio))
+        return latent_shapes
+    
+    @staticmethod
+    def _shape_key(kwargs: dict) -> tuple:
+        """Get the shapes, dtypes and constant values a package is specialized to."""
+        return tuple(
+            (name, tuple(value.shape), str(value.dtype))
+            if isinstance(value, torch.Tensor) else (name, repr(value))
+            for name, value in sorted(kwargs.items())
+        )
+    
+    def _load_runner(self, key: tuple, kwargs: dict):
+        """Load the package for a shape key, exporting and compiling it if missing."""
+        digest = hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+        path = self.cache_dir / f"{self.tag}-{digest}.pt2"
+        
+        try:
+            if path.exists():
+                # Mark the package as recently used for eviction
+                os.utime(path)
+            else:
+                self._compile_package(path, kwargs)
+                self._evict_packages(keep=path)
+            runner = torch._inductor.aoti_load_package(str(path))
+            runner.load_constants(
+                self._module().state_dict(), check_full_update=True, user_managed=True
+            )
+        except Exception as e:
+            logger.warning(f"AOT compilation unavailable for {path.name}, running eager ({e})")
+            return self._eager
+        
+        logger.info(f"Loaded AOT-compiled transformer: {path.name}")
+        return runner
+    
+    def _compile_package(self, path: Path, kwargs: dict) -> None:
+        """Export the transformer for the given inputs and compile it to a package."""
+        logger.info(f"AOT-compiling transformer for new input shapes: {path.name}")
+        exported = torch.export.export(self._module(), args=(), kwargs=kwargs, strict=False)
+        
+        # Compile beside the target and rename, so readers never see partial packages
+        partial = self.cache_dir / "partial" / f"{path.stem}.{os.getpid()}.pt2"
+        partial.parent.mkdir(parents=True, exist_ok=True)
+        torch._inductor.aoti_compile_and_package(
+            exported,
+            package_path=str(partial),
+            inductor_configs={"aot_inductor.package_constants_in_so": False},
+        )
+        os.replace(partial, path)
+    
+    def _evict_packages(self, keep: Path) -> None:
+        """Delete the least recently used packages over the cap."""
+        packages = [p for p in self.cache_dir.glob("*.pt2") if p != keep]
+        packages.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+        for stale in packages[max(self.max_packages - 1, 0):]:
+            stale.unlink(missing_ok=True)
+            logger.info(f"Evicted AOT-compiled transformer: {stale.name}")
+    
+    def _module(self) -> torch.nn.Module:
+        """Get a module running the eager forward, for export and weight names."""
+        eager = self._eager
+        
+        class EagerTransformer(torch.nn.Module):
+            def __init__(self, transformer):
+                super().__init__()
+                self.transformer = transformer
+            
+            def forward(self, **kwargs):
+                return eager(**kwargs)
+        
+        return EagerTransformer(self.transformer)
+
+
 class LTXVideoWrapper:
     """Wrapper for LTX-Video model."""
     
@@ -61,7 +348,15 @@ class LTXVideoWrapper:
         model_id: str = DISTILLED_MODEL,
         device: Optional[str] = None,
         dtype: Optional[torch.dtype] = None,
-        enable_model_cpu_offload: bool = True,
+        cpu_offload: str = "auto",
+        flashpack_path: Optional[Union[str, Path]] = None,
+        precision: str = "bf16",
+        compile_model: bool = False,
+        compile_mode: str = "max-autotune",
+        attention_backend: Optional[str] = ATTENTION_BACKEND,
+        compile_cache_dir: Optional[Union[str, Path]] = AOT_CACHE_DIR,
+        multi_gpu: bool = MULTI_GPU,
+        device_map: Optional[Union[str, Dict[str, Union[int, str]]]] = None,
     ):
         """
         Initialize LTX-Video wrapper.
@@ -70,67 +365,81 @@ class LTXVideoWrapper:
             model_id: HuggingFace model ID or local path
             device: Device to run on (cuda, mps, cpu)
             dtype: Model precision (float16, bfloat16, float32)
-            enable_model_cpu_offload: Enable CPU offload for low VRAM
+            cpu_offload: CPU offload mode (auto, none, model, sequential)
+            flashpack_path: Optional FlashPack file to stream transformer weights from
+            precision: Transformer weight precision (bf16, fp8, nf4, int8)
+            compile_model: Compile the transformer and VAE decoder with torch.compile
+            compile_mode: torch.compile mode
+            attention_backend: diffusers attention backend (flash, _flash_3, sage, xformers)
+            compile_cache_dir: Optional directory of AOTInductor-compiled transformers
+            multi_gpu: Place the pipeline's components across all visible GPUs
+            device_map: Placement used with multi_gpu, either a strategy or a mapping
+                of component names (text_encoder, transformer, vae) to devices
+                (default: balanced)
         """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}. Choose from: {list(PRECISIONS)}")
+        
         self.model_id = model_id
-        self.device = device or self._detect_device()
-        self.dtype = dtype or self._get_optimal_dtype()
-        self.enable_cpu_offload = enable_model_cpu_offload
+        self.device = device or detect_device()
+        self.dtype = dtype or optimal_dtype(self.device)
+        self.multi_gpu = multi_gpu and self._supports_multi_gpu()
+        self.device_map = device_map or "balanced"
+        self.cpu_offload = self._resolve_offload(cpu_offload)
+        self.flashpack_path = Path(flashpack_path) if flashpack_path else None
+        self.precision = precision
+        self.compile_model = compile_model
+        self.compile_mode = compile_mode
+        self.attention_backend = attention_backend
+        self.compile_cache_dir = Path(compile_cache_dir) if compile_cache_dir else None
         
         self._text2video_pipeline: Optional[LTXPipeline] = None
         self._img2video_pipeline: Optional[LTXImageToVideoPipeline] = None
+        # First-block cache threshold per loaded transformer, keyed on id()
+        self._cache_thresholds: dict = {}
+        # Set when the pipelines are compiled with CUDA graphs
+        self._step_callback = None
+        # The VAE's own tile size and stride, restored when a request sets none
+        self._vae_default_tile: Optional[tuple] = None
+        # Per-thread generator reseeded for each seeded request
+        self._generators = threading.local()
         
         logger.info(f"LTX-Video initialized: device={self.device}, dtype={self.dtype}")
     
-    def _detect_device(self) -> str:
-        """Detect the best available device."""
-        if torch.cuda.is_available():
-            return "cuda"
-        elif torch.backends.mps.is_available():
-            return "mps"
-        return "cpu"
-    
-    def _get_optimal_dtype(self) -> torch.dtype:
-        """Get optimal dtype for the device."""
-        if self.device == "cuda":
-            # Use bfloat16 for newer GPUs
-            if torch.cuda.is_bf16_supported():
-                return torch.bfloat16
-            return torch.float16
-        elif self.device == "mps":
-            return torch.float16
-        return torch.float32
+    def _supports_multi_gpu(self) -> bool:
+        """Check whether there are several CUDA devices to place the pipeline on."""
+        if self.device != "cuda" or torch.cuda.device_count() < 2:
+            logger.info("multi_gpu disabled: fewer than two CUDA devices visible")
+            return False
+        return True
+    
+    def _resolve_offload(self, mode: str) -> str:
+        """
+        Resolve the CPU offload mode, choosing one from free VRAM in auto mode.
+        
+        Args:
+            mode: auto, none, model or sequential
+        """
+        if self.multi_gpu and mode in OFFLOAD_MODES:
+            # Components spread over the GPUs' combined VRAM replace offloading
+            if mode not in ("auto", "none"):
+                logger.info(f"Ignoring {mode} CPU offload with multi_gpu")
+            return "none"
+        
+        footprint_gb = PIPELINE_VRAM_GB.get(self.model_id, DEFAULT_VRAM_GB)
+        return resolve_offload(mode, self.device, footprint_gb)
     
     def ensure_model_downloaded(self) -> Path:
         """Ensure model weights are downloaded."""
-        models_dir = MODELS_DIR / self.model_id.replace("/", "_")
-        
-        if not models_dir.exists():
-            logger.info(f"Downloading model: {self.model_id}")
-            snapshot_download(
-                repo_id=self.model_id,
-                local_dir=models_dir,
-                ignore_patterns=["*.md", "*.txt"],
-            )
-            logger.info("Model download complete")
-        
-        return models_dir
+        return download_snapshot(self.model_id, MODELS_DIR / self.model_id.replace("/", "_"))
     
     def _load_text2video_pipeline(self) -> LTXPipeline:
         """Load the text-to-video pipeline."""
         if self._text2video_pipeline is None:
             logger.info("Loading text-to-video pipeline...")
-            
-            self._text2video_pipeline = LTXPipeline.from_pretrained(
-                self.model_id,
-                torch_dtype=self.dtype,
+            self._text2video_pipeline = self._load_pipeline(
+                LTXPipeline, self._img2video_pipeline
             )
-            
-            if self.enable_cpu_offload and self.device == "cuda":
-                self._text2video_pipeline.enable_model_cpu_offload()
-            else:
-                self._text2video_pipeline = self._text2video_pipeline.to(self.device)
-            
             logger.info("Text-to-video pipeline loaded")
         
         return self._text2video_pipeline
@@ -139,21 +448,205 @@ class LTXVideoWrapper:
         """Load the image-to-video pipeline."""
         if self._img2video_pipeline is None:
             logger.info("Loading image-to-video pipeline...")
-            
-            self._img2video_pipeline = LTXImageToVideoPipeline.from_pretrained(
-                self.model_id,
-                torch_dtype=self.dtype,
+            self._img2video_pipeline = self._load_pipeline(
+                LTXImageToVideoPipeline, self._text2video_pipeline
             )
-            
-            if self.enable_cpu_offload and self.device == "cuda":
-                self._img2video_pipeline.enable_model_cpu_offload()
-            else:
-                self._img2video_pipeline = self._img2video_pipeline.to(self.device)
-            
             logger.info("Image-to-video pipeline loaded")
         
         return self._img2video_pipeline
     
+    def _cache_key(self, pipeline_cls) -> tuple:
+        """Get the key of a pipeline in the shared pipeline cache."""
+        return (
+            pipeline_cls.__name__,
+            self.model_id,
+            self.device,
+            str(self.dtype),
+            self.cpu_offload,
+            self.precision,
+            self.compile_model,
+            self.compile_mode,
+            self.attention_backend,
+            self.compile_cache_dir,
+            self.multi_gpu and str(self.device_map),
+        )
+    
+    def _load_pipeline(self, pipeline_cls, loaded=None):
+        """
+        Get a pipeline from the shared cache, building it on a miss.
+        
+        Args:
+            pipeline_cls: LTXPipeline or LTXImageToVideoPipeline
+            loaded: The other pipeline, if it is loaded
+        """
+        key = self._cache_key(pipeline_cls)
+        pipeline = _PIPELINE_CACHE.get(key)
+        if pipeline is None:
+            # Drop pipelines loaded with other options before building, so a
+            # swap doesn't keep two sets of weights in memory
+            stale = [k for k in _PIPELINE_CACHE if k[1:] != key[1:]]
+            for stale_key in stale:
+                del _PIPELINE_CACHE[stale_key]
+            if stale and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            
+            pipeline = self._build_pipeline(pipeline_cls, loaded)
+            _PIPELINE_CACHE[key] = pipeline
+        else:
+            logger.info(f"Reusing cached {pipeline_cls.__name__}")
+        
+        self._vae_default_tile = (
+            pipeline.vae.tile_sample_min_height,
+            pipeline.vae.tile_sample_stride_height,
+        )
+        self._step_callback = cudagraph_step_callback(pipeline, self.compile_mode)
+        
+        return pipeline
+    
+    def _build_pipeline(self, pipeline_cls, loaded=None):
+        """
+        Load a pipeline, sharing modules with the other loaded pipeline if possible.
+        
+        Both pipelines use the same weights, so the second one is built from
+        the first one's modules, reusing the already compiled transformer and
+        VAE. Offloaded pipelines are loaded separately, since each one
+        installs its own offload hooks on its modules.
+        
+        Args:
+            pipeline_cls: LTXPipeline or LTXImageToVideoPipeline
+            loaded: The other pipeline, if it is loaded
+        """
+        if loaded is not None and self.cpu_offload == "none":
+            return pipeline_cls.from_pipe(loaded)
+        
+        if self.multi_gpu:
+            device_map = self.device_map
+        else:
+            device_map = direct_device_map(self.device, self.cpu_offload)
+        pipeline = pipeline_cls.from_pretrained(
+            self.model_id,
+            torch_dtype=self.dtype,
+            low_cpu_mem_usage=True,
+            device_map=device_map,
+            **transformer_components(
+                LTXVideoTransformer3DModel,
+                self.model_id,
+                self.precision,
+                self.flashpack_path,
+                self.device,
+                self.dtype,
+                self.cpu_offload,
+            ),
+        )
+        
+        if self.precision == "fp8":
+            quantize_fp8(pipeline.transformer)
+        
+        pipeline = prepare_pipeline(
+            pipeline,
+            self.device,
+            self.cpu_offload,
+            placed=device_map is not None,
+            vae_memory_format=torch.channels_last_3d,
+            attention_backend=self.attention_backend,
+        )
+        
+        if self.compile_cache_dir is not None:
+            self._enable_aot_transformer(pipeline)
+        
+        if self.compile_model:
+            compile_pipeline(
+                pipeline,
+                self.device,
+                self.cpu_offload,
+                self.compile_mode,
+                MODELS_DIR / ".compile_cache",
+                # An AOT-compiled transformer already runs compiled kernels
+                compile_transformer=self.compile_cache_dir is None,
+            )
+        
+        return pipeline
+    
+    def _enable_aot_transformer(self, pipeline) -> None:
+        """Run the transformer from AOTInductor packages kept in the compile cache directory."""
+        if self.device != "cuda" or self.cpu_offload != "none":
+            logger.warning("Skipping AOT compilation: requires CUDA without CPU offload")
+            return
+        
+        # Compiled kernels depend on the model, load options, GPU and torch build
+        options = (
+            self.model_id,
+            str(self.dtype),
+            self.precision,
+            self.attention_backend,
+            torch.cuda.get_device_name(),
+            torch.__version__,
+        )
+        digest = hashlib.sha256(repr(options).encode()).hexdigest()[:16]
+        tag = f"{self.model_id.replace('/', '_')}-{self.precision}-{digest}"
+        
+        AOTTransformerForward(
+            pipeline.transformer,
+            self.compile_cache_dir,
+            tag,
+            AOT_SHAPES,
+            spatial_ratio=pipeline.vae_spatial_compression_ratio,
+            temporal_ratio=pipeline.vae_temporal_compression_ratio,
+        )
+    
+    def warmup(self) -> None:
+        """Load the text-to-video pipeline and run a tiny generation to prime CUDA kernels."""
+        pipeline = self._load_text2video_pipeline()
+        
+        logger.info("Warming up text-to-video pipeline...")
+        with torch.inference_mode():
+            pipeline(
+                prompt="warmup",
+                width=256,
+                height=256,
+                num_frames=25,
+                num_inference_steps=1,
+                callback_on_step_end=self._step_callback,
+            )
+        logger.info("Text-to-video pipeline warm")
+    
+    def _set_cache_threshold(self, pipeline, threshold: float) -> None:
+        """Enable, retune or disable the first-block cache on a pipeline's transformer."""
+        transformer = pipeline.transformer
+        self._cache_thresholds[id(transformer)] = set_first_block_cache(
+            transformer, self._cache_thresholds.get(id(transformer), 0.0), threshold
+        )
+    
+    def _set_vae_tile_size(self, pipeline, tile_size: Optional[int]) -> None:
+        """Set the VAE decode tile size in pixels, or restore the default for None."""
+        if tile_size:
+            # Keep the default stride-to-size ratio so tiles still overlap
+            default_size, default_stride = self._vae_default_tile
+            stride = tile_size * default_stride // default_size
+        else:
+            tile_size, stride = self._vae_default_tile
+        
+        pipeline.vae.enable_tiling(
+            tile_sample_min_height=tile_size,
+            tile_sample_min_width=tile_size,
+            tile_sample_stride_height=stride,
+            tile_sample_stride_width=stride,
+        )
+    
+    def _generator(self, seed: Optional[int]) -> Optional[torch.Generator]:
+        """
+        Get this thread's generator seeded for a request, or None without a seed.
+        
+        Unseeded requests draw from the global RNG, so they need no generator.
+        """
+        if seed is None:
+            return None
+        
+        generator = getattr(self._generators, "generator", None)
+        if generator is None:
+            generator = self._generators.generator = torch.Generator(device=self.device)
+        return generator.manual_seed(seed)
+    
     def generate_video(self, config: VideoGenerationConfig) -> str:
         """
         Generate a video from text prompt.
@@ -165,11 +658,11 @@ class LTXVideoWrapper:
             Path to generated video file
         """
         pipeline = self._load_text2video_pipeline()
+        self._set_cache_threshold(pipeline, config.cache_threshold)
+        self._set_vae_tile_size(pipeline, config.vae_tile_size)
         
         # Set seed for reproducibility
-        generator = None
-        if config.seed is not None:
-            generator = torch.Generator(device=self.device).manual_seed(config.seed)
+        generator = self._generator(config.seed)
         
         logger.info(f"Generating video: {config.prompt[:50]}...")
         
@@ -183,6 +676,8 @@ class LTXVideoWrapper:
             num_inference_steps=config.num_inference_steps,
             guidance_scale=config.guidance_scale,
             generator=generator,
+            output_type="pt",
+            callback_on_step_end=self._step_callback,
         )
         
         # Save video
@@ -203,15 +698,15 @@ class LTXVideoWrapper:
             Path to generated video file
         """
         pipeline = self._load_img2video_pipeline()
+        self._set_cache_threshold(pipeline, config.cache_threshold)
+        self._set_vae_tile_size(pipeline, config.vae_tile_size)
         
         # Load input image
         image = Image.open(config.image_path).convert("RGB")
         image = image.resize((config.width, config.height))
         
         # Set seed for reproducibility
-        generator = None
-        if config.seed is not None:
-            generator = torch.Generator(device=self.device).manual_seed(config.seed)
+        generator = self._generator(config.seed)
         
         logger.info(f"Generating video from image: {config.image_path}")
         
@@ -226,6 +721,8 @@ class LTXVideoWrapper:
             num_inference_steps=config.num_inference_steps,
             guidance_scale=config.guidance_scale,
             generator=generator,
+            output_type="pt",
+            callback_on_step_end=self._step_callback,
         )
         
         # Save video
@@ -235,37 +732,82 @@ class LTXVideoWrapper:
         logger.info(f"Video saved to: {output_path}")
         return output_path
     
-    def _save_video(self, frames: List, output_path: str, fps: int) -> None:
-        """Save frames as video file."""
+    def _save_video(self, frames: torch.Tensor, output_path: str, fps: int) -> None:
+        """
+        Save frames as video file.
+        
+        Args:
+            frames: (frames, channels, height, width) tensor with values in [0, 1]
+            output_path: Path of the video file
+            fps: Frames per second
+        """
+        # Convert the whole clip to THWC uint8 at once instead of per PIL frame
+        video = frames.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+        video = video.permute(0, 2, 3, 1).cpu()
+        
+        if HAS_TORCHVISION_IO:
+            try:
+                write_video(output_path, video, fps=fps, video_codec="libx264")
+                return
+            except (ImportError, RuntimeError) as e:
+                # Builds without video support or an unusable PyAV/libx264
+                logger.warning(f"torchvision video encoding failed ({e}), using imageio")
+        
         try:
-            from diffusers.utils import export_to_video
-            export_to_video(frames, output_path, fps=fps)
+            import imageio  # noqa: F401
         except ImportError:
-            # Fallback to manual saving
-            import imageio
-            writer = imageio.get_writer(output_path, fps=fps)
-            for frame in frames:
-                writer.append_data(frame)
-            writer.close()
-    
-    def unload(self) -> None:
-        """Unload pipelines to free memory."""
+            # Fallback to diffusers' exporter, which takes float frames
+            from diffusers.utils import export_to_video
+            float_frames = frames.permute(0, 2, 3, 1).float().cpu().numpy()
+            export_to_video(list(float_frames), output_path, fps=fps)
+            return
+        
+        with BufferedVideoWriter(output_path, fps) as writer:
+            for frame in video.numpy():
+                writer.write_frame(frame)
+    
+    def unload(self, purge: bool = False) -> None:
+        """
+        Release the pipelines.
+        
+        Args:
+            purge: Also drop them from the shared pipeline cache to free memory.
+                Otherwise they stay loaded for the next wrapper with the same options.
+        """
+        for pipeline_cls, pipeline in (
+            (LTXPipeline, self._text2video_pipeline),
+            (LTXImageToVideoPipeline, self._img2video_pipeline),
+        ):
+            if purge:
+                _PIPELINE_CACHE.pop(self._cache_key(pipeline_cls), None)
+            elif pipeline is not None:
+                threshold = self._cache_thresholds.get(id(pipeline.transformer), 0.0)
+                restore_pipeline_defaults(pipeline, threshold, self._set_vae_tile_size)
+        
         self._text2video_pipeline = None
         self._img2video_pipeline = None
+        self._cache_thresholds.clear()
+        self._step_callback = None
         
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        
-        logger.info("Pipelines unloaded")
+        if purge:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            logger.info("Pipelines unloaded")
     
     def get_model_info(self) -> dict:
         """Get information about the loaded model."""
         return {
             "model_id": self.model_id,
             "device": self.device,
+            "cpu_offload": self.cpu_offload,
             "dtype": str(self.dtype),
+            "precision": self.precision,
+            "compiled": self.compile_model,
+            "compile_mode": self.compile_mode,
+            "multi_gpu": self.multi_gpu,
             "text2video_loaded": self._text2video_pipeline is not None,
             "img2video_loaded": self._img2video_pipeline is not None,
+            "cache_thresholds": list(self._cache_thresholds.values()),
         }
 
 